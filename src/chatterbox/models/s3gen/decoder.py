@@ -11,6 +11,9 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -247,27 +250,73 @@ class ConditionalDecoder(nn.Module):
         Returns:
             _type_: _description_
         """
+        prepared = self.prepare(mask, mu, spks, cond)
+        prepared.set_x(x)
+        return self._forward(prepared, self.embed_times(t))
 
+    def embed_times(self, t):
         t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
+        return self.time_mlp(t)
 
-        x = pack([x, mu], "b * t")[0]
+    def prepare(self, mask, mu, spks=None, cond=None, times=(), feature_cache=None) -> "DecoderConditioning":
+        """
+        Computes what does not depend on the ODE step once per utterance: the masks and attention biases of every
+        U-Net level, the packed [x | mu | spks | cond] input and the time embeddings of `times` (python floats).
 
+        With a `feature_cache` policy, `forward_prepared` skips the mid blocks on some of the `len(times)` steps.
+        """
+        assert feature_cache is None or len(times) > 0, "feature caching needs the solver times"
+        x = torch.zeros_like(mu[:, :self.out_channels])
+        x = pack([x, mu], "b * t")[0]
         if spks is not None:
             spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
             x = pack([x, spks], "b * t")[0]
         if cond is not None:
             x = pack([x, cond], "b * t")[0]
 
+        masks, attn_biases = [], []
+        for i in range(len(self.down_blocks)):
+            masks.append(mask if i == 0 else masks[-1][:, :, ::2])
+            # attn_mask = torch.matmul(mask.transpose(1, 2).contiguous(), mask)
+            attn_mask = add_optional_chunk_mask(
+                masks[-1].transpose(1, 2), masks[-1].bool(), False, False, 0, self.static_chunk_size, -1
+            )
+            attn_biases.append(mask_to_bias(attn_mask == 1, x.dtype))
+
+        time_embs = {}
+        if len(times) > 0:
+            t_embs = self.embed_times(torch.tensor(list(times), device=mu.device, dtype=mu.dtype))
+            time_embs = {t: t_emb[None] for t, t_emb in zip(times, t_embs)}
+        return DecoderConditioning(
+            inputs=x,
+            masks=masks,
+            attn_biases=attn_biases,
+            time_embs=time_embs,
+            num_steps=len(times),
+            feature_cache=feature_cache,
+        )
+
+    def forward_prepared(self, prepared: "DecoderConditioning", t: float):
+        "One step on `prepared`, whose x channels were set with `set_x`, at time `t`."
+        t_emb = prepared.time_embs.get(t)
+        if t_emb is None:
+            x = prepared.inputs
+            t_emb = prepared.time_embs[t] = self.embed_times(torch.tensor([t], device=x.device, dtype=x.dtype))
+        policy = prepared.feature_cache
+        step, prepared.step = prepared.step, prepared.step + 1
+        reuse_mid = (
+            policy is not None and prepared.mid_cache is not None and not policy.is_full(step, prepared.num_steps)
+        )
+        return self._forward(prepared, t_emb, reuse_mid=reuse_mid)
+
+    def _forward(self, prepared: "DecoderConditioning", t, reuse_mid=False):
+        x = prepared.inputs
+        masks, attn_biases = prepared.masks, prepared.attn_biases
+
         hiddens = []
-        masks = [mask]
-        for resnet, transformer_blocks, downsample in self.down_blocks:
-            mask_down = masks[-1]
+        for (resnet, transformer_blocks, downsample), mask_down, attn_mask in zip(self.down_blocks, masks, attn_biases):
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -277,33 +326,33 @@ class ConditionalDecoder(nn.Module):
             x = rearrange(x, "b t c -> b c t").contiguous()
             hiddens.append(x)  # Save hidden states for skip connections
             x = downsample(x * mask_down)
-            masks.append(mask_down[:, :, ::2])
-        masks = masks[:-1]
-        mask_mid = masks[-1]
-
-        for resnet, transformer_blocks in self.mid_blocks:
-            x = resnet(x, mask_mid, t)
-            x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
-            for transformer_block in transformer_blocks:
-                x = transformer_block(
-                    hidden_states=x,
-                    attention_mask=attn_mask,
-                    timestep=t,
-                )
-            x = rearrange(x, "b t c -> b c t").contiguous()
+        mask_mid, attn_mask = masks[-1], attn_biases[-1]
+
+        policy = prepared.feature_cache
+        if reuse_mid:
+            x = prepared.mid_cache if policy.reuse == "feature" else x + prepared.mid_cache
+        else:
+            x_mid = x
+            for resnet, transformer_blocks in self.mid_blocks:
+                x = resnet(x, mask_mid, t)
+                x = rearrange(x, "b c t -> b t c").contiguous()
+                for transformer_block in transformer_blocks:
+                    x = transformer_block(
+                        hidden_states=x,
+                        attention_mask=attn_mask,
+                        timestep=t,
+                    )
+                x = rearrange(x, "b t c -> b c t").contiguous()
+            if policy is not None:
+                prepared.mid_cache = x if policy.reuse == "feature" else x - x_mid
 
-        for resnet, transformer_blocks, upsample in self.up_blocks:
-            mask_up = masks.pop()
+        for (resnet, transformer_blocks, upsample), mask_up, attn_mask in zip(
+            self.up_blocks, masks[::-1], attn_biases[::-1]
+        ):
             skip = hiddens.pop()
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -314,4 +363,59 @@ class ConditionalDecoder(nn.Module):
             x = upsample(x * mask_up)
         x = self.final_block(x, mask_up)
         output = self.final_proj(x * mask_up)
-        return output * mask
+        return output * masks[0]
+
+
+@dataclass
+class DecoderConditioning:
+    """
+    The step-invariant inputs of a `ConditionalDecoder` for one batch, see `ConditionalDecoder.prepare`. Only the x
+    channels of `inputs` change between ODE steps.
+    """
+    # (B, C, T) packed [x | mu | spks | cond]
+    inputs: torch.Tensor
+    # (B, 1, T) mask of each U-Net level, and the matching attention bias
+    masks: List[torch.Tensor]
+    attn_biases: List[torch.Tensor]
+    # time -> (1, time_embed_dim)
+    time_embs: Dict[float, torch.Tensor] = field(default_factory=dict)
+    # mid-block caching: the number of solver steps, the policy, the step count so far and the cached activations
+    num_steps: int = 0
+    feature_cache: Optional["FeatureCachePolicy"] = None
+    step: int = 0
+    mid_cache: Optional[torch.Tensor] = None
+
+    def set_x(self, x):
+        "Writes `x` (b, C, T) to the x channels, repeated over the rows when the B rows are B // b copies (CFG)."
+        self.inputs[:, :x.size(1)].view(-1, *x.shape)[:] = x
+
+
+@dataclass(frozen=True)
+class FeatureCachePolicy:
+    """
+    DeepCache-style reuse of the `ConditionalDecoder` mid blocks (12 of its 14 resnet + transformer stages) across
+    ODE steps: deep features change little between neighbouring steps, so only the shallow down / up path is
+    recomputed on the steps in between full ones.
+
+    - `interval`: one full step every `interval` steps (1 disables the cache)
+    - `warmup` / `cooldown`: the first / last steps that are always full (the flow moves the most near the noise)
+    - `reuse`: "feature" reuses the cached mid-block output as is (DeepCache), "residual" adds the cached mid-block
+      residual to the fresh down-block output
+    """
+    interval: int = 2
+    warmup: int = 1
+    cooldown: int = 0
+    reuse: str = "feature"
+
+    def __post_init__(self):
+        assert self.interval >= 1
+        assert self.reuse in ("feature", "residual"), f"unknown reuse mode {self.reuse}"
+
+    def is_full(self, step: int, num_steps: int) -> bool:
+        "Whether the mid blocks run on `step` (of `num_steps` estimator calls)."
+        if step < self.warmup or step >= num_steps - self.cooldown:
+            return True
+        return (step - self.warmup) % self.interval == 0
+
+    def num_full_steps(self, num_steps: int) -> int:
+        return sum(self.is_full(step, num_steps) for step in range(num_steps))
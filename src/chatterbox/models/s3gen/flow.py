@@ -13,12 +13,15 @@
 # limitations under the License.
 import logging
 import random
+from dataclasses import dataclass, replace
 from typing import Dict, Optional
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
 from .utils.mask import make_pad_mask
 from .configs import CFM_PARAMS
+from .ode_solvers import ODESolver
+from .transformer.upsample_encoder import EncoderChunkCache
 
 
 class MaskedDiffWithXvec(torch.nn.Module):
@@ -242,41 +245,277 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  finalize):
+                  finalize,
+                  solver: Optional[ODESolver] = None):
+        """
+        Rows of `token` (B, T) are right-padded to `token_len` (B,), and so are the prompts of their ref dicts,
+        with `prompt_feat_len` (B,) None when all the prompts have the same length.
+
+        `solver` overrides the decoder's 10-step Euler, see `ode_solvers`.
+
+        Returns: the generated mels (B, 80, T'), right-padded, and their lengths (B,).
+        """
         if self.fp16 is True:
             prompt_feat = prompt_feat.half()
             embedding = embedding.half()
 
-        assert token.shape[0] == 1
         # xvec projection
         embedding = F.normalize(embedding, dim=1)
         embedding = self.spk_embed_affine_layer(embedding)
 
         # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+        token, token_len = self._concat_prompt(prompt_token, prompt_token_len, token, token_len)
         mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
         token = self.input_embedding(torch.clamp(token, min=0)) * mask
 
         # text encode
-        h, h_lengths = self.encoder(token, token_len)
+        h, _ = self.encoder(token, token_len)
+        mel_len = token_len * self.token_mel_ratio
         if finalize is False:
-            h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
-        mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
+            mel_len = mel_len - self.pre_lookahead_len * self.token_mel_ratio
+            h = h[:, :int(mel_len.max())]
+        h = self.encoder_proj(h)
+        return self._decode(h, mel_len, prompt_feat, prompt_feat_len, embedding, solver)
+
+    @torch.inference_mode()
+    def prepare_prompt(self,
+                       prompt_token,
+                       prompt_token_len,
+                       prompt_feat,
+                       prompt_feat_len,
+                       embedding,
+                       decoder_prompt_frames: Optional[int] = None) -> "PromptCache":
+        """
+        Encodes a (single) reference prompt once, for `inference_cached`, from the values of its ref dict.
+
+        `decoder_prompt_frames` limits how many of the last prompt mel frames the CFM decoder still gets as
+        in-context conditioning (None: all of them, like `inference`). Fewer frames make the decoder cost scale with
+        the output rather than prompt + output, at some cost in speaker similarity.
+        """
+        assert prompt_token.size(0) == 1, "one prompt per cache"
+        # `embed_ref` can leave an extra (odd) mel frame; keep the tokens and mels aligned, so the cached prompt
+        # frames (and the streaming window) line up with the frames of the new tokens
+        num_tokens = min(prompt_token.shape[1], prompt_feat.shape[1] // self.token_mel_ratio)
+        prompt_token = prompt_token[:, :num_tokens]
+        prompt_feat = prompt_feat[:, :num_tokens * self.token_mel_ratio]
+        if self.fp16 is True:
+            prompt_feat = prompt_feat.half()
+            embedding = embedding.half()
+
+        # xvec projection
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+
+        # encode all the prompt tokens but the last `pre_lookahead_len`, which look ahead into the new ones
+        token = self.input_embedding(torch.clamp(prompt_token, min=0)).to(embedding)
+        h, encoder_cache = self.encoder.forward_chunk(token, final=False)
+        return PromptCache(
+            embedding=embedding,
+            encoder_cache=encoder_cache,
+            mu=self.encoder_proj(h),
+            prompt_feat=prompt_feat,
+            decoder_prompt_frames=decoder_prompt_frames,
+        )
+
+    @torch.inference_mode()
+    def inference_cached(self,
+                         token,
+                         token_len,
+                         prompt_cache: "PromptCache",
+                         finalize,
+                         solver: Optional[ODESolver] = None):
+        """
+        `inference` for a prompt prepared by `prepare_prompt`: only the new tokens (and the last
+        `pre_lookahead_len` prompt ones) go through the encoder, attending to the cached prompt keys / values.
+        The prompt encodings do not attend to the new tokens (chunk-causal, like the streaming flow), so the mels
+        differ slightly from `inference`.
+        """
+        B = token.size(0)
+        embedding = prompt_cache.embedding.expand(B, -1)
+
+        mask = (~make_pad_mask(token_len, token.size(1))).unsqueeze(-1).to(embedding)
+        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+
+        # text encode, after the cached prompt
+        encoder_cache = prompt_cache.encoder_cache
+        h, _ = self.encoder.forward_chunk(token, token_len, cache=encoder_cache.expand(B), final=True)
+        h = torch.cat([prompt_cache.mu.expand(B, -1, -1), self.encoder_proj(h)], dim=1)
+        mel_len = prompt_cache.mu.size(1) + (encoder_cache.num_pending + token_len) * self.token_mel_ratio
+        if finalize is False:
+            mel_len = mel_len - self.pre_lookahead_len * self.token_mel_ratio
+            h = h[:, :int(mel_len.max())]
+
+        # only keep the last `decoder_prompt_frames` of the prompt as decoder context
+        prompt_feat = prompt_cache.prompt_feat
+        num_dropped = 0
+        if prompt_cache.decoder_prompt_frames is not None:
+            num_dropped = max(0, prompt_feat.shape[1] - prompt_cache.decoder_prompt_frames)
+        h, mel_len, prompt_feat = h[:, num_dropped:], mel_len - num_dropped, prompt_feat[:, num_dropped:]
+        prompt_feat = prompt_feat.expand(B, -1, -1)
+        return self._decode(h, mel_len, prompt_feat, None, embedding, solver, noise_offset=num_dropped)
+
+    def start_stream(self, prompt_cache: "PromptCache", context_frames: int = 34) -> "FlowStreamState":
+        """
+        The state of a new streamed utterance for `inference_chunk`, after the prompt of `prompt_cache`.
+
+        `context_frames`: how many of the last generated mel frames the CFM decoder gets as in-context conditioning
+        (like the prompt) when generating the next ones, for continuity across chunks.
+        """
+        prompt_feat = prompt_cache.prompt_feat
+        num_prompt_frames = prompt_feat.shape[1]
+        window = num_prompt_frames
+        if prompt_cache.decoder_prompt_frames is not None:
+            window = min(window, prompt_cache.decoder_prompt_frames)
+        num_pending = prompt_cache.encoder_cache.num_pending * self.token_mel_ratio
+        empty = prompt_feat[:, :0]
+        return FlowStreamState(
+            prompt_cache=prompt_cache,
+            encoder_cache=prompt_cache.encoder_cache,
+            prompt_mu=prompt_cache.mu[:, min(num_prompt_frames - window, prompt_cache.mu.size(1)):],
+            prompt_mel=prompt_feat[:, num_prompt_frames - window:],
+            num_prompt_pending=num_pending,
+            context_mu=empty,
+            context_mel=empty,
+            num_generated=0,
+            context_frames=context_frames,
+        )
+
+    @torch.inference_mode()
+    def inference_chunk(self,
+                        token,
+                        state: "FlowStreamState",
+                        finalize,
+                        solver: Optional[ODESolver] = None):
+        """
+        Streams the mels of one utterance chunk by chunk, at a cost that depends on the chunk and not on the tokens
+        generated so far: the encoder only encodes the new tokens `token` (1, T), attending to its cached keys /
+        values, and the CFM decoder only generates the new frames, conditioned on the (windowed) prompt and the last
+        `context_frames` generated frames. The noise of every frame comes from its absolute position in the
+        utterance, as in `inference_cached`.
+
+        The last `pre_lookahead_len` tokens are held back until the next chunk, or until `finalize`.
+
+        Returns: the new mels (1, 80, T') and the state for the next chunk.
+        """
+        assert token.size(0) == 1, "one utterance per stream"
+        embedding = state.prompt_cache.embedding
+        token = self.input_embedding(torch.clamp(token, min=0)).to(embedding)
+        h, encoder_cache = self.encoder.forward_chunk(token, cache=state.encoder_cache, final=finalize)
         h = self.encoder_proj(h)
 
+        # the first frames out of the encoder finish the prompt
+        window = state.prompt_mel.size(1)
+        num_prompt = min(state.num_prompt_pending, h.size(1))
+        prompt_mu = torch.cat([state.prompt_mu, h[:, :num_prompt]], dim=1)
+        prompt_mu = prompt_mu[:, max(0, prompt_mu.size(1) - window):]
+        h = h[:, num_prompt:]
+        state = replace(
+            state,
+            encoder_cache=encoder_cache,
+            prompt_mu=prompt_mu,
+            num_prompt_pending=state.num_prompt_pending - num_prompt,
+        )
+        if h.size(1) == 0:
+            return h.new_zeros(1, self.output_size, 0).float(), state
+
+        # decode [prompt window | generated context | new frames], with the known mels as conditioning
+        known_mel = torch.cat([state.prompt_mel, state.context_mel], dim=1)
+        mu = torch.cat([prompt_mu, state.context_mu, h], dim=1)
+        num_prompt_frames = state.prompt_cache.prompt_feat.shape[1]
+        noise_offset = num_prompt_frames + state.num_generated - known_mel.size(1)
+        mel_len = torch.tensor([mu.size(1)], device=mu.device)
+        feat, _ = self._decode(mu, mel_len, known_mel, None, embedding, solver, noise_offset=noise_offset)
+
+        context_mu = torch.cat([state.context_mu, h], dim=1)
+        context_mel = torch.cat([state.context_mel, feat.transpose(1, 2).to(h)], dim=1)
+        context = max(0, context_mu.size(1) - state.context_frames)
+        state = replace(
+            state,
+            context_mu=context_mu[:, context:],
+            context_mel=context_mel[:, context:],
+            num_generated=state.num_generated + h.size(1),
+        )
+        return feat, state
+
+    def _decode(self, h, mel_len, prompt_feat, prompt_feat_len, embedding, solver, noise_offset=0):
+        "Runs the CFM decoder on the encoded prompt + tokens `h` (B, T, 80), and drops the prompt part."
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
+        if prompt_feat_len is None:
+            prompt_feat_len = torch.full_like(mel_len, prompt_feat.shape[1])
+        prompt_feat_len = prompt_feat_len.to(mel_len)
+        prompt_mask = (~make_pad_mask(prompt_feat_len, prompt_feat.shape[1])).unsqueeze(-1)
+        conds = torch.zeros([h.size(0), h.shape[1], self.output_size], device=h.device).to(h.dtype)
+        conds[:, :prompt_feat.shape[1]] = prompt_feat * prompt_mask.to(prompt_feat)
         conds = conds.transpose(1, 2)
 
-        mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
+        mask = (~make_pad_mask(mel_len, h.shape[1])).to(h)
         feat, _ = self.decoder(
             mu=h.transpose(1, 2).contiguous(),
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10
+            n_timesteps=10,
+            solver=solver,
+            noise_offset=noise_offset,
         )
-        feat = feat[:, :, mel_len1:]
-        assert feat.shape[2] == mel_len2
-        return feat.float(), None  # NOTE jrm: why are they returning None here?
+
+        # drop the prompt part of each row
+        feat_len = mel_len - prompt_feat_len
+        if feat.size(0) == 1:
+            feat = feat[:, :, int(prompt_feat_len[0]):]
+        else:
+            out = feat.new_zeros(feat.size(0), feat.size(1), int(feat_len.max()))
+            for i, (start, n) in enumerate(zip(prompt_feat_len.tolist(), feat_len.tolist())):
+                out[i, :, :n] = feat[i, :, start:start + n]
+            feat = out
+        assert feat.shape[2] == feat_len.max()
+        return feat.float(), feat_len
+
+    @staticmethod
+    def _concat_prompt(prompt_token, prompt_token_len, token, token_len):
+        "Puts the tokens of each row right after its own (right-padded) prompt."
+        prompt_token_len = prompt_token_len.to(token_len)
+        if token.size(0) == 1:
+            return torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+        concat_len = prompt_token_len + token_len
+        concat = token.new_zeros(token.size(0), int(concat_len.max()))
+        for i, (n_prompt, n) in enumerate(zip(prompt_token_len.tolist(), token_len.tolist())):
+            concat[i, :n_prompt] = prompt_token[i, :n_prompt]
+            concat[i, n_prompt:n_prompt + n] = token[i, :n]
+        return concat, concat_len
+
+
+@dataclass
+class PromptCache:
+    """
+    Everything `CausalMaskedDiffWithXvec.inference_cached` reuses of one voice's reference prompt, from
+    `prepare_prompt`: the projected speaker embedding, the encoder state after the prompt tokens, the encoded
+    prompt frames (`mu`, (1, F', 80)) and the prompt mels (1, F, 80).
+    """
+    embedding: torch.Tensor
+    encoder_cache: EncoderChunkCache
+    mu: torch.Tensor
+    prompt_feat: torch.Tensor
+    decoder_prompt_frames: Optional[int] = None
+
+
+@dataclass
+class FlowStreamState:
+    """
+    State of one utterance streamed by `CausalMaskedDiffWithXvec.inference_chunk`, from `start_stream`:
+
+    - `encoder_cache`: the encoder state after the tokens so far
+    - `prompt_mu` / `prompt_mel`: encoded frames and mels of the prompt window the decoder is conditioned on,
+      (1, W, 80); the last `num_prompt_pending` prompt frames are only encoded with the first chunk
+    - `context_mu` / `context_mel`: the same for the last (up to `context_frames`) generated frames
+    - `num_generated`: mel frames generated so far
+    """
+    prompt_cache: PromptCache
+    encoder_cache: EncoderChunkCache
+    prompt_mu: torch.Tensor
+    prompt_mel: torch.Tensor
+    num_prompt_pending: int
+    context_mu: torch.Tensor
+    context_mel: torch.Tensor
+    num_generated: int
+    context_frames: int
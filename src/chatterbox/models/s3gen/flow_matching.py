@@ -12,10 +12,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import threading
+from typing import Optional
+
 import torch
 import torch.nn.functional as F
 from .matcha.flow_matching import BASECFM
 from .configs import CFM_PARAMS
+from .ode_solvers import ODESolver, euler
 
 
 class ConditionalCFM(BASECFM):
@@ -84,55 +87,72 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
+        t_span = t_span.tolist()
+        velocity = self.cfg_velocity(x, mu, mask, spks, cond, times=t_span[:-1])
+        return euler(velocity, x, t_span).float()
+
+    def solve(self, x, solver: ODESolver, mu, mask, spks, cond):
+        "Integrates the flow from the noise `x` with `solver` (see `ode_solvers`)."
+        velocity = self.cfg_velocity(
+            x, mu, mask, spks, cond, times=solver.eval_times(), feature_cache=solver.feature_cache,
+        )
+        return solver.solve(velocity, x).float()
 
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
+    def cfg_velocity(self, x, mu, mask, spks, cond, times=(), feature_cache=None):
+        """
+        The classifier-free guided velocity v(x, t) of the estimator, for the B rows of `x`: every call is one
+        estimator pass on 2B rows, the B cond rows first, then the B uncond rows.
 
+        Everything but x and t is set up once here, including the time embeddings of `times`, the (python float)
+        times the solver will ask for. `feature_cache` (a `FeatureCachePolicy`) only applies to torch estimators.
+        """
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in
+        B = x.size(0)
+        x_in = torch.zeros([2 * B, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        mask_in = torch.zeros([2 * B, 1, x.size(2)], device=x.device, dtype=x.dtype)
+        mu_in = torch.zeros([2 * B, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        t_in = torch.zeros([2 * B], device=x.device, dtype=x.dtype)
+        spks_in = torch.zeros([2 * B, 80], device=x.device, dtype=x.dtype)
+        cond_in = torch.zeros([2 * B, 80, x.size(2)], device=x.device, dtype=x.dtype)
+        # Classifier-Free Guidance inference introduced in VoiceBox
+        mask_in[:B] = mask
+        mask_in[B:] = mask
+        mu_in[:B] = mu
+        spks_in[:B] = spks
+        cond_in[:B] = cond
+
+        def guide(dphi_dt):
+            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [B, B], dim=0)
+            return (1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt
+
+        if isinstance(self.estimator, torch.nn.Module):
+            prepared = self.estimator.prepare(
+                mask_in, mu_in, spks_in, cond_in, times=times, feature_cache=feature_cache,
             )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
 
-        return sol[-1].float()
+            def velocity(x, t):
+                prepared.set_x(x)
+                return guide(self.estimator.forward_prepared(prepared, t))
+        else:
+            def velocity(x, t):
+                x_in[:B] = x
+                x_in[B:] = x
+                t_in[:] = t
+                return guide(self.forward_estimator(x_in, mask_in, mu_in, t_in, spks_in, cond_in))
+
+        return velocity
 
     def forward_estimator(self, x, mask, mu, t, spks, cond):
         if isinstance(self.estimator, torch.nn.Module):
             return self.estimator.forward(x, mask, mu, t, spks, cond)
         else:
             with self.lock:
-                self.estimator.set_input_shape('x', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('mask', (2, 1, x.size(2)))
-                self.estimator.set_input_shape('mu', (2, 80, x.size(2)))
-                self.estimator.set_input_shape('t', (2,))
-                self.estimator.set_input_shape('spks', (2, 80))
-                self.estimator.set_input_shape('cond', (2, 80, x.size(2)))
+                self.estimator.set_input_shape('x', (x.size(0), 80, x.size(2)))
+                self.estimator.set_input_shape('mask', (x.size(0), 1, x.size(2)))
+                self.estimator.set_input_shape('mu', (x.size(0), 80, x.size(2)))
+                self.estimator.set_input_shape('t', (x.size(0),))
+                self.estimator.set_input_shape('spks', (x.size(0), 80))
+                self.estimator.set_input_shape('cond', (x.size(0), 80, x.size(2)))
                 # run trt engine
                 self.estimator.execute_v2([x.contiguous().data_ptr(),
                                            mask.contiguous().data_ptr(),
@@ -191,7 +211,10 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(
+        self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, solver: Optional[ODESolver] = None,
+        noise_offset=0,
+    ):
         """Forward diffusion
 
         Args:
@@ -204,15 +227,18 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (ODESolver, optional): ODE solver, step count and t-schedule, overriding `n_timesteps`.
+                Defaults to the `cfm_params` ones.
+            noise_offset (int, optional): first frame of the fixed noise to use, when leading frames were cut.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
-        # fix prompt and overlap part mu and z
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
-        if self.t_scheduler == 'cosine':
-            t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
+        # (every row of a batch starts from the same noise as it would alone)
+        z = self.rand_noise[:, :, noise_offset:noise_offset + mu.size(2)].to(mu.device).to(mu.dtype)
+        z = z.expand(mu.size(0), -1, -1) * temperature
+        if solver is None:
+            solver = ODESolver(self.solver, n_timesteps, self.t_scheduler)
+        return self.solve(z, solver, mu=mu, mask=mask, spks=spks, cond=cond), None
@@ -203,15 +203,31 @@ class SineGen(torch.nn.Module):
         :param f0: [B, 1, sample_len], Hz
         :return: [B, 1, sample_len]
         """
+        cycles = torch.zeros((f0.size(0), self.harmonic_num + 1, 1), device=f0.device)
+        sine_waves, uv, noise, _ = self.forward_stream(f0, cycles, self.initial_phases(f0.size(0), f0.device))
+        return sine_waves, uv, noise
 
+    def initial_phases(self, batch_size, device):
+        "Random initial phases of the harmonics [B, harmonic_num + 1, 1], 0 for the fundamental."
+        u_dist = Uniform(low=-np.pi, high=np.pi)
+        phase_vec = u_dist.sample(sample_shape=(batch_size, self.harmonic_num + 1, 1)).to(device)
+        phase_vec[:, 0, :] = 0
+        return phase_vec
+
+    @torch.no_grad()
+    def forward_stream(self, f0, cycles, phase_vec):
+        """
+        `forward` for the next samples of a longer f0 track, continuing the sines of the previous ones
+        :param cycles: [B, harmonic_num + 1, 1], cycles of each harmonic so far (mod 1), zeros at the start
+        :param phase_vec: [B, harmonic_num + 1, 1], the `initial_phases` of the track
+        :return: sine waves, uv and noise [B, 1, sample_len], and the cycles after this f0
+        """
         F_mat = torch.zeros((f0.size(0), self.harmonic_num + 1, f0.size(-1))).to(f0.device)
         for i in range(self.harmonic_num + 1):
             F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
 
-        theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
-        phase_vec[:, 0, :] = 0
+        cycles_mat = torch.cumsum(F_mat, dim=-1) + cycles
+        theta_mat = 2 * np.pi * (cycles_mat % 1)
 
         # generate sine waveforms
         sine_waves = self.sine_amp * torch.sin(theta_mat + phase_vec)
@@ -228,7 +244,9 @@ class SineGen(torch.nn.Module):
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
         sine_waves = sine_waves * uv + noise
-        return sine_waves, uv, noise
+        if f0.size(-1) > 0:
+            cycles = cycles_mat[:, :, -1:] % 1
+        return sine_waves, uv, noise, cycles
 
 
 class SourceModuleHnNSF(torch.nn.Module):
@@ -282,6 +300,16 @@ class SourceModuleHnNSF(torch.nn.Module):
         noise = torch.randn_like(uv) * self.sine_amp / 3
         return sine_merge, noise, uv
 
+    def forward_stream(self, x, cycles, phase_vec):
+        "`forward` for the next samples of a longer F0 track (see `SineGen.forward_stream`), also returns the cycles."
+        with torch.no_grad():
+            sine_wavs, uv, _, cycles = self.l_sin_gen.forward_stream(x.transpose(1, 2), cycles, phase_vec)
+            sine_wavs = sine_wavs.transpose(1, 2)
+            uv = uv.transpose(1, 2)
+        sine_merge = self.l_tanh(self.l_linear(sine_wavs))
+        noise = torch.randn_like(uv) * self.sine_amp / 3
+        return sine_merge, noise, uv, cycles
+
 
 class HiFTGenerator(nn.Module):
     """
@@ -460,7 +488,20 @@ class HiFTGenerator(nn.Module):
         return generated_speech, f0
 
     @torch.inference_mode()
-    def inference(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
+    def inference(
+        self,
+        speech_feat: torch.Tensor,
+        cache_source: torch.Tensor = torch.zeros(1, 1, 0),
+        speech_feat_len: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        `speech_feat_len` (B,) gives the lengths of right-padded mels. Each row is then vocoded at its own length,
+        exactly as it would be alone (masking the padding is not enough: the biases of every conv, and of the F0
+        predictor, make it non-zero again within their receptive field), and the source and the speech are
+        zero-padded past each row's length.
+        """
+        if speech_feat_len is not None:
+            return self._inference_rows(speech_feat, cache_source, speech_feat_len)
         # mel->f0
         f0 = self.f0_predictor(speech_feat)
         # f0->source
@@ -472,3 +513,20 @@ class HiFTGenerator(nn.Module):
             s[:, :, :cache_source.shape[2]] = cache_source
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
+
+    def _inference_rows(self, speech_feat, cache_source, speech_feat_len):
+        spf = self.samples_per_frame
+        T = speech_feat.size(2)
+        speech = speech_feat.new_zeros(speech_feat.size(0), T * spf)
+        source = speech_feat.new_zeros(speech_feat.size(0), 1, T * spf)
+        for i, n in enumerate(speech_feat_len.tolist()):
+            row_cache = cache_source[i:i + 1] if cache_source.size(0) > 1 else cache_source
+            row_speech, row_source = self.inference(speech_feat[i:i + 1, :, :n], row_cache[:, :, :n * spf])
+            speech[i, :n * spf] = row_speech[0]
+            source[i, :, :n * spf] = row_source[0]
+        return speech, source
+
+    @property
+    def samples_per_frame(self):
+        "Waveform samples per mel frame."
+        return int(self.f0_upsamp.scale_factor)
@@ -0,0 +1,208 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+import math
+from typing import Optional
+
+import torch
+from torch import Tensor
+
+from .hifigan import HiFTGenerator
+
+
+# frames of mel context on each side of an F0 estimate (5 convs of kernel 3 in `ConvRNNF0Predictor`)
+F0_RECEPTIVE_FIELD = 5
+
+
+def _conv_reach(conv) -> int:
+    "Input samples a stride-1 conv (or the input of a strided one) reaches on its farther side."
+    k, d, p = conv.kernel_size[0], conv.dilation[0], conv.padding[0]
+    return max(p, (k - 1) * d - p)
+
+
+def _resblock_reach(resblock) -> int:
+    return sum(_conv_reach(c1) + _conv_reach(c2) for c1, c2 in zip(resblock.convs1, resblock.convs2))
+
+
+def hift_receptive_field(hift: HiFTGenerator):
+    """
+    How far, in mel frames on either side, an output sample of `hift.decode` reaches into its inputs, from the
+    module config: into the mels (through `conv_pre`, the upsampling and every ResBlock level down to the ISTFT),
+    and into the NSF source (through the source STFT, `source_downs` / `source_resblocks` and the levels after the
+    one they are fused into).
+
+    Returns: (mel frames, source frames), as floats
+    """
+    n_fft, hop = hift.istft_params["n_fft"], hift.istft_params["hop_len"]
+    rates = []  # samples per mel frame after each upsampling level
+    rate = 1
+    for up in hift.ups:
+        rate *= up.stride[0]
+        rates.append(rate)
+    istft_reach = (n_fft // 2) / rate  # ISTFT overlap, at the rate of the last level (one STFT frame per sample)
+
+    def level_reach(i):
+        "Reach of level `i`'s ResBlocks (the widest branch)."
+        resblocks = hift.resblocks[i * hift.num_kernels:(i + 1) * hift.num_kernels]
+        return max(_resblock_reach(r) for r in resblocks) / rates[i]
+
+    def upsample_reach(i):
+        up = hift.ups[i]
+        k, u, p = up.kernel_size[0], up.stride[0], up.padding[0]
+        return (max(p, k - 1 - p) + u - 1) / rates[i]
+
+    # reach of everything after the fusion of level i
+    downstream = [0.0] * len(rates)
+    tail = (1 + _conv_reach(hift.conv_post)) / rates[-1] + istft_reach  # (+ the reflection pad)
+    for i in reversed(range(len(rates))):
+        downstream[i] = level_reach(i) + tail
+        if i > 0:
+            tail = upsample_reach(i) + downstream[i]
+
+    mel_reach = _conv_reach(hift.conv_pre) + upsample_reach(0) + downstream[0]
+    stft_reach = (n_fft // 2) / (rates[-1] * hop)
+    source_reach = max(
+        stft_reach + _conv_reach(down) / rates[-1] + _resblock_reach(resblock) / rates[i] + downstream[i]
+        for i, (down, resblock) in enumerate(zip(hift.source_downs, hift.source_resblocks))
+    )
+    return mel_reach, source_reach
+
+
+def min_margins(hift: HiFTGenerator):
+    """
+    The smallest (context, lookahead) frames for which `StreamingHiFT` matches whole-utterance vocoding: the
+    lookahead must also keep the provisional source of the last `F0_RECEPTIVE_FIELD` frames out of reach.
+    """
+    mel_reach, source_reach = hift_receptive_field(hift)
+    context = math.ceil(max(mel_reach, source_reach, F0_RECEPTIVE_FIELD))
+    lookahead = math.ceil(max(mel_reach, F0_RECEPTIVE_FIELD + source_reach))
+    return context, lookahead
+
+
+class StreamingHiFT:
+    """
+    Vocodes the mels of one utterance as they arrive, with a `HiFTGenerator`: `push` successive (1, 80, T) mel
+    chunks and get the waveform of all but the last `lookahead_frames` frames back, the rest with the last chunk.
+
+    Every call vocodes a window of `context_frames` already vocoded frames, the new ones and the lookahead, and
+    only keeps the samples of the new frames, so its cost does not grow with the utterance. The NSF source is
+    generated once per frame, when its F0 is final, continuing the sine phases of the previous frames; the frames
+    still waiting for F0 lookahead get a provisional source.
+
+    The margins default to (and must be at least) `min_margins`, which cover the receptive field of the decoder
+    so the seams match whole-utterance vocoding: 16 frames of context and 20 of lookahead (400ms, the latency the
+    vocoder adds) for the S3Gen config.
+    """
+
+    def __init__(
+        self,
+        hift: HiFTGenerator,
+        context_frames: Optional[int] = None,
+        lookahead_frames: Optional[int] = None,
+        record_source: bool = False,
+    ):
+        min_context, min_lookahead = min_margins(hift)
+        context_frames = min_context if context_frames is None else context_frames
+        lookahead_frames = min_lookahead if lookahead_frames is None else lookahead_frames
+        assert context_frames >= min_context, f"context_frames must cover the receptive field ({min_context})"
+        assert lookahead_frames >= min_lookahead, f"lookahead_frames must cover the receptive field ({min_lookahead})"
+        self.hift = hift
+        self.context_frames = context_frames
+        self.lookahead_frames = lookahead_frames
+        param = next(hift.parameters())
+        sine_gen = hift.m_source.l_sin_gen
+
+        self.mels = param.new_zeros(1, hift.conv_pre.in_channels, 0)  # frames `mel_start` onwards
+        self.mel_start = 0
+        self.source = param.new_zeros(1, 1, 0)  # final source of frames `source_start` to `source_end`
+        self.source_start = 0
+        self.source_end = 0
+        self.cycles = param.new_zeros(1, sine_gen.harmonic_num + 1, 1)
+        self.phase_vec = sine_gen.initial_phases(1, param.device)
+        self.num_done = 0  # frames vocoded
+        self.finished = False
+        # all the final source, for `compare_streaming_vocoder`
+        self.recorded_source = [] if record_source else None
+
+    @property
+    def num_frames(self):
+        return self.mel_start + self.mels.size(2)
+
+    @torch.inference_mode()
+    def push(self, speech_feat: Tensor, final: bool = False) -> Tensor:
+        """
+        Args:
+            speech_feat: the next mel frames (1, 80, T), T can be 0
+            final: no more frames follow, flush everything
+        Returns: the waveform (1, samples) of the frames that became ready, possibly empty
+        """
+        assert not self.finished, "the utterance was already flushed"
+        self.finished = final
+        hift = self.hift
+        spf = hift.samples_per_frame
+        self.mels = torch.cat([self.mels, speech_feat.to(self.mels)], dim=2)
+        num_frames = self.num_frames
+        end = num_frames if final else max(self.num_done, num_frames - self.lookahead_frames)
+        if end == self.num_done:
+            return self.mels.new_zeros(1, 0)
+
+        start = max(0, self.num_done - self.context_frames)
+        mels = self.mels[:, :, start - self.mel_start:]
+        f0 = hift.f0_predictor(mels)
+
+        # final source for the frames with a final F0, a provisional one for the rest of the window
+        source_end = num_frames if final else max(self.source_end, num_frames - F0_RECEPTIVE_FIELD)
+        new_source, self.cycles = self._source(f0[:, self.source_end - start:source_end - start], self.cycles)
+        tail_source, _ = self._source(f0[:, source_end - start:], self.cycles)
+        self.source = torch.cat([self.source, new_source], dim=2)
+        self.source_end = source_end
+        if self.recorded_source is not None:
+            self.recorded_source.append(new_source)
+        s = torch.cat([self.source[:, :, (start - self.source_start) * spf:], tail_source], dim=2)
+
+        wav = hift.decode(x=mels, s=s)
+        wav = wav[:, (self.num_done - start) * spf:(end - start) * spf]
+        self.num_done = end
+
+        # drop what the next windows no longer need
+        keep = max(0, end - self.context_frames)
+        self.mels = self.mels[:, :, keep - self.mel_start:]
+        self.mel_start = keep
+        self.source = self.source[:, :, (keep - self.source_start) * spf:]
+        self.source_start = keep
+        return wav
+
+    def _source(self, f0: Tensor, cycles: Tensor):
+        if f0.size(1) == 0:
+            return f0.new_zeros(1, 1, 0), cycles
+        s = self.hift.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
+        s, _, _, cycles = self.hift.m_source.forward_stream(s, cycles, self.phase_vec)
+        return s.transpose(1, 2), cycles
+
+
+@torch.inference_mode()
+def compare_streaming_vocoder(hift: HiFTGenerator, speech_feat: Tensor, chunk_frames=10, **kwargs):
+    """
+    Measures `StreamingHiFT` (with `kwargs`) against whole-utterance vocoding of the mels `speech_feat` (1, 80, T)
+    pushed in chunks of `chunk_frames`. The NSF source is random, so the reference is one `decode` pass over all
+    the mels with the source the stream generated: the difference is what streaming itself costs.
+
+    Returns: a dict with the max / mean absolute sample difference, the SNR of the stream against the reference in
+    dB, and the number of samples.
+    """
+    speech_feat = speech_feat.to(next(hift.parameters()))
+    stream = StreamingHiFT(hift, record_source=True, **kwargs)
+    chunks = speech_feat.split(chunk_frames, dim=2)
+    wav = torch.cat([
+        stream.push(chunk, final=i == len(chunks) - 1) for i, chunk in enumerate(chunks)
+    ], dim=1)
+    ref_wav = hift.decode(x=speech_feat, s=torch.cat(stream.recorded_source, dim=2))
+    assert wav.shape == ref_wav.shape
+
+    diff = (wav - ref_wav).float()
+    snr = 10 * torch.log10(ref_wav.float().pow(2).sum() / diff.pow(2).sum().clamp(min=1e-12))
+    return dict(
+        max_abs=float(diff.abs().max()),
+        mean_abs=float(diff.abs().mean()),
+        snr_db=float(snr),
+        num_samples=wav.size(1),
+    )
@@ -0,0 +1,210 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+import torch
+from torch import Tensor
+
+from .decoder import FeatureCachePolicy
+
+
+# v(x, t): the (CFG-combined) velocity of the flow at time t (a python float or a 0D tensor)
+Velocity = Callable[[Tensor, float], Tensor]
+
+
+def time_schedule(n_timesteps, t_scheduler="cosine", device=None, dtype=None) -> Tensor:
+    """
+    The (n_timesteps + 1,) times from 0 (noise) to 1 (mel) the solver steps through.
+
+    - "linear": uniform steps
+    - "cosine": `1 - cos(t * pi / 2)`, small steps near the noise where the flow changes the most (training default)
+    """
+    t_span = torch.linspace(0, 1, n_timesteps + 1, device=device, dtype=dtype)
+    if t_scheduler == "cosine":
+        t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
+    else:
+        assert t_scheduler == "linear", f"unknown t_scheduler {t_scheduler}"
+    return t_span
+
+
+def euler(velocity: Velocity, x: Tensor, t_span: Tensor) -> Tensor:
+    for t0, t1 in zip(t_span[:-1], t_span[1:]):
+        x = x + (t1 - t0) * velocity(x, t0)
+    return x
+
+
+def midpoint(velocity: Velocity, x: Tensor, t_span: Tensor) -> Tensor:
+    "Explicit midpoint (RK2), 2 evaluations per step."
+    for t0, t1 in zip(t_span[:-1], t_span[1:]):
+        h = t1 - t0
+        x_mid = x + 0.5 * h * velocity(x, t0)
+        x = x + h * velocity(x_mid, t0 + 0.5 * h)
+    return x
+
+
+def heun(velocity: Velocity, x: Tensor, t_span: Tensor) -> Tensor:
+    "Heun's method (trapezoidal RK2), 2 evaluations per step."
+    for t0, t1 in zip(t_span[:-1], t_span[1:]):
+        h = t1 - t0
+        v0 = velocity(x, t0)
+        v1 = velocity(x + h * v0, t1)
+        x = x + 0.5 * h * (v0 + v1)
+    return x
+
+
+def multistep(velocity: Velocity, x: Tensor, t_span: Tensor) -> Tensor:
+    """
+    Second-order multistep (variable-step Adams-Bashforth, the velocity counterpart of DPM-Solver++(2M)): one
+    evaluation per step, the previous velocity supplies the second-order correction.
+    """
+    v_prev, h_prev = None, None
+    for t0, t1 in zip(t_span[:-1], t_span[1:]):
+        h = t1 - t0
+        v = velocity(x, t0)
+        if v_prev is None:
+            x = x + h * v
+        else:
+            r = 0.5 * h / h_prev
+            x = x + h * ((1 + r) * v - r * v_prev)
+        v_prev, h_prev = v, h
+    return x
+
+
+ODE_SOLVERS = {
+    "euler": euler,
+    "midpoint": midpoint,
+    "heun": heun,
+    "multistep": multistep,
+}
+
+EVALS_PER_STEP = {
+    "euler": 1,
+    "midpoint": 2,
+    "heun": 2,
+    "multistep": 1,
+}
+
+
+@dataclass(frozen=True)
+class ODESolver:
+    """
+    How the CFM decoder integrates its flow, set per request. Each estimator call is a 2-row CFG pass through
+    the `ConditionalDecoder`, so the cost is `num_evals`, not `n_timesteps`, and less with a `feature_cache`
+    policy, which skips the decoder mid blocks on all but `num_full_evals` of them.
+    """
+    method: str = "euler"
+    n_timesteps: int = 10
+    t_scheduler: str = "cosine"
+    feature_cache: Optional[FeatureCachePolicy] = None
+
+    def __post_init__(self):
+        assert self.method in ODE_SOLVERS, f"unknown ODE solver {self.method}"
+
+    @property
+    def num_evals(self):
+        return EVALS_PER_STEP[self.method] * self.n_timesteps
+
+    @property
+    def num_full_evals(self):
+        if self.feature_cache is None:
+            return self.num_evals
+        return self.feature_cache.num_full_steps(self.num_evals)
+
+    def t_span(self, device=None, dtype=None):
+        return time_schedule(self.n_timesteps, self.t_scheduler, device=device, dtype=dtype)
+
+    def eval_times(self):
+        "The times (python floats) `solve` evaluates the velocity at, in order."
+        t_span = self.t_span(dtype=torch.float64).tolist()
+        steps = list(zip(t_span[:-1], t_span[1:]))
+        if self.method == "midpoint":
+            return [t for t0, t1 in steps for t in (t0, t0 + 0.5 * (t1 - t0))]
+        if self.method == "heun":
+            return [t for step in steps for t in step]
+        return [t0 for t0, _ in steps]
+
+    def solve(self, velocity: Velocity, x: Tensor) -> Tensor:
+        # (times stay on the host: no device scalars or syncs between steps)
+        return ODE_SOLVERS[self.method](velocity, x, self.t_span(dtype=torch.float64).tolist())
+
+
+# the 10-step Euler the decoder was tuned with
+REFERENCE_SOLVER = ODESolver("euler", 10, "cosine")
+
+# 4-6 estimator calls each
+FAST_SOLVERS = {
+    "multistep4": ODESolver("multistep", 4, "cosine"),
+    "multistep5": ODESolver("multistep", 5, "cosine"),
+    "multistep6": ODESolver("multistep", 6, "cosine"),
+    "heun2": ODESolver("heun", 2, "linear"),
+    "heun3": ODESolver("heun", 3, "cosine"),
+    "midpoint2": ODESolver("midpoint", 2, "linear"),
+    "midpoint3": ODESolver("midpoint", 3, "cosine"),
+}
+
+# mid-block feature caching on top of the reference solver and a fast one
+CACHED_SOLVERS = {
+    "euler10_cache2": ODESolver("euler", 10, "cosine", FeatureCachePolicy(interval=2, warmup=1)),
+    "euler10_cache3": ODESolver("euler", 10, "cosine", FeatureCachePolicy(interval=3, warmup=1, cooldown=1)),
+    "euler10_cache2_residual": ODESolver(
+        "euler", 10, "cosine", FeatureCachePolicy(interval=2, warmup=1, reuse="residual"),
+    ),
+    "multistep6_cache2": ODESolver("multistep", 6, "cosine", FeatureCachePolicy(interval=2, warmup=2)),
+}
+
+
+@torch.inference_mode()
+def benchmark_solvers(
+    s3gen,
+    speech_tokens: Tensor,
+    ref_dict: dict,
+    solvers: Optional[Dict[str, ODESolver]] = None,
+    reference: ODESolver = REFERENCE_SOLVER,
+    num_runs=3,
+):
+    """
+    Runs the flow of `s3gen` (an `S3Token2Wav`) with each of `solvers` (default `FAST_SOLVERS`, or eg
+    `CACHED_SOLVERS`) and with the `reference` solver. The CFM noise is fixed, so the mel distance only measures the
+    integration (and feature caching) error.
+
+    Returns: {name: dict(num_evals, num_full_evals, seconds, mel_l1, mel_max)}, with the mean absolute and max
+    log-mel distance to the reference, and the best-of-`num_runs` wall clock; the reference is under "reference".
+    """
+    solvers = dict(FAST_SOLVERS if solvers is None else solvers)
+
+    def run(solver: ODESolver):
+        seconds = []
+        for _ in range(num_runs):
+            _synchronize(s3gen.device)
+            t0 = time.perf_counter()
+            mels = s3gen.flow_inference(speech_tokens, ref_dict=ref_dict, finalize=True, solver=solver)
+            _synchronize(s3gen.device)
+            seconds.append(time.perf_counter() - t0)
+        return mels.float(), min(seconds)
+
+    ref_mels, ref_seconds = run(reference)
+    results = dict(reference=dict(
+        num_evals=reference.num_evals,
+        num_full_evals=reference.num_full_evals,
+        seconds=ref_seconds,
+        mel_l1=0.0,
+        mel_max=0.0,
+    ))
+    for name, solver in solvers.items():
+        mels, seconds = run(solver)
+        diff = (mels - ref_mels).abs()
+        results[name] = dict(
+            num_evals=solver.num_evals,
+            num_full_evals=solver.num_full_evals,
+            seconds=seconds,
+            mel_l1=float(diff.mean()),
+            mel_max=float(diff.max()),
+        )
+    return results
+
+
+def _synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
@@ -18,23 +18,31 @@ import numpy as np
 import torch
 import torchaudio as ta
 from functools import lru_cache
-from typing import Optional
+from typing import Iterable, Iterator, List, Optional, Union
 
 from ..s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, S3Tokenizer
 from .const import S3GEN_SR
-from .flow import CausalMaskedDiffWithXvec
+from .flow import CausalMaskedDiffWithXvec, PromptCache
 from .xvector import CAMPPlus
 from .utils.mel import mel_spectrogram
 from .f0_predictor import ConvRNNF0Predictor
 from .hifigan import HiFTGenerator
+from .hift_stream import StreamingHiFT
 from .transformer.upsample_encoder import UpsampleConformerEncoder
 from .flow_matching import CausalConditionalCFM
 from .decoder import ConditionalDecoder
 from .configs import CFM_PARAMS
+from .ode_solvers import ODESolver
 
 
 def drop_invalid_tokens(x):
-    assert len(x.shape) <= 2 and x.shape[0] == 1, "only batch size of one allowed for now"
+    """
+    Drops the non-speech tokens of `x`, 1D or [B=1, T], as one 1D tensor. For a [B, T] batch, returns a list
+    with the valid tokens of each row, which are of different lengths.
+    """
+    assert len(x.shape) <= 2
+    if len(x.shape) == 2 and x.shape[0] > 1:
+        return [row[row < SPEECH_VOCAB_SIZE] for row in x]
     return x[x < SPEECH_VOCAB_SIZE]
 
 
@@ -165,6 +173,7 @@ class S3Token2Mel(torch.nn.Module):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        solver: Optional[ODESolver] = None,
     ):
         """
         Generate waveforms from S3 speech tokens and a reference waveform, which the speaker timbre is inferred from.
@@ -181,33 +190,111 @@ class S3Token2Mel(torch.nn.Module):
         - `ref_wav`: reference waveform (`torch.Tensor` with shape=[B=1, T])
         - `ref_sr`: reference sample rate
         - `finalize`: whether streaming is finished or not. Note that if False, the last 3 tokens will be ignored.
+        - `solver`: the CFM decoder's ODE solver / step count (see `ode_solvers`), 10-step Euler by default
+
+        `ref_dict` can also be a `PromptCache` from `prepare_prompt_cache`, which skips re-encoding the prompt.
         """
         assert (ref_wav is None) ^ (ref_dict is None), f"Must provide exactly one of ref_wav or ref_dict (got {ref_wav} and {ref_dict})"
 
-        if ref_dict is None:
-            ref_dict = self.embed_ref(ref_wav, ref_sr)
-        else:
-            # type/device casting (all values will be numpy if it's from a prod API call)
-            for rk in list(ref_dict):
-                if isinstance(ref_dict[rk], np.ndarray):
-                    ref_dict[rk] = torch.from_numpy(ref_dict[rk])
-                if torch.is_tensor(ref_dict[rk]):
-                    ref_dict[rk] = ref_dict[rk].to(self.device)
-
         if len(speech_tokens.shape) == 1:
             speech_tokens = speech_tokens.unsqueeze(0)
 
         # assert speech_tokens.shape[0] == 1, "only batch size of one allowed for now"
         speech_token_lens = torch.LongTensor([speech_tokens.size(1)]).to(self.device)
 
+        if isinstance(ref_dict, PromptCache):
+            output_mels, _ = self.flow.inference_cached(
+                token=speech_tokens,
+                token_len=speech_token_lens,
+                prompt_cache=ref_dict,
+                finalize=finalize,
+                solver=solver,
+            )
+            return output_mels
+
+        if ref_dict is None:
+            ref_dict = self.embed_ref(ref_wav, ref_sr)
+        else:
+            ref_dict = self._cast_ref_dict(ref_dict)
+
         output_mels, _ = self.flow.inference(
             token=speech_tokens,
             token_len=speech_token_lens,
             finalize=finalize,
+            solver=solver,
             **ref_dict,
         )
         return output_mels
 
+    @torch.inference_mode()
+    def prepare_prompt_cache(self, ref_dict: dict, decoder_prompt_frames: Optional[int] = None) -> PromptCache:
+        """
+        Encodes the prompt of a voice once; pass the result instead of its `ref_dict` to only encode the new tokens
+        on every request (see `CausalMaskedDiffWithXvec.prepare_prompt` for `decoder_prompt_frames`).
+        """
+        ref_dict = self._cast_ref_dict(dict(ref_dict))
+        return self.flow.prepare_prompt(**ref_dict, decoder_prompt_frames=decoder_prompt_frames)
+
+    def _cast_ref_dict(self, ref_dict: dict):
+        # type/device casting (all values will be numpy if it's from a prod API call)
+        for rk in list(ref_dict):
+            if isinstance(ref_dict[rk], np.ndarray):
+                ref_dict[rk] = torch.from_numpy(ref_dict[rk])
+            if torch.is_tensor(ref_dict[rk]):
+                ref_dict[rk] = ref_dict[rk].to(self.device)
+        return ref_dict
+
+    def collate_ref_dicts(self, ref_dicts: List[dict]):
+        "Stacks single-row ref dicts into one batched ref dict, with right-padded prompts."
+        ref_dicts = [self._cast_ref_dict(dict(ref_dict)) for ref_dict in ref_dicts]
+        prompt_tokens = [d["prompt_token"].view(-1) for d in ref_dicts]
+        prompt_feats = [d["prompt_feat"].squeeze(0) for d in ref_dicts]
+        pad = torch.nn.utils.rnn.pad_sequence
+        return dict(
+            prompt_token=pad(prompt_tokens, batch_first=True),
+            prompt_token_len=torch.tensor([len(t) for t in prompt_tokens], device=self.device),
+            prompt_feat=pad(prompt_feats, batch_first=True),
+            prompt_feat_len=torch.tensor([len(f) for f in prompt_feats], device=self.device),
+            embedding=torch.cat([d["embedding"].view(1, -1) for d in ref_dicts]),
+        )
+
+    def forward_batch(
+        self,
+        speech_tokens: List[torch.Tensor],
+        ref_dicts: Union[dict, PromptCache, List[dict]],
+        finalize: bool = True,
+        solver: Optional[ODESolver] = None,
+    ):
+        """
+        Batched `forward`, for several 1D token sequences of different lengths, each with its own ref dict (or all
+        with the same one, or the same `PromptCache`).
+
+        Returns: the mels (B, 80, T), right-padded, and their lengths (B,).
+        """
+        if isinstance(ref_dicts, PromptCache):
+            speech_tokens = [t.view(-1).to(self.device) for t in speech_tokens]
+            return self.flow.inference_cached(
+                token=torch.nn.utils.rnn.pad_sequence(speech_tokens, batch_first=True),
+                token_len=torch.tensor([len(t) for t in speech_tokens], device=self.device),
+                prompt_cache=ref_dicts,
+                finalize=finalize,
+                solver=solver,
+            )
+        if isinstance(ref_dicts, dict):
+            ref_dicts = [ref_dicts] * len(speech_tokens)
+        assert len(ref_dicts) == len(speech_tokens)
+        speech_tokens = [t.view(-1).to(self.device) for t in speech_tokens]
+        speech_token_lens = torch.tensor([len(t) for t in speech_tokens], device=self.device)
+        speech_tokens = torch.nn.utils.rnn.pad_sequence(speech_tokens, batch_first=True)
+
+        return self.flow.inference(
+            token=speech_tokens,
+            token_len=speech_token_lens,
+            finalize=finalize,
+            solver=solver,
+            **self.collate_ref_dicts(ref_dicts),
+        )
+
 
 class S3Token2Wav(S3Token2Mel):
     """
@@ -243,11 +330,15 @@ class S3Token2Wav(S3Token2Mel):
         ref_sr: Optional[int],
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
-        finalize: bool = False
+        finalize: bool = False,
+        solver: Optional[ODESolver] = None,
     ):
-        output_mels = super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        output_mels = super().forward(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize, solver=solver,
+        )
 
-        # TODO jrm: ignoring the speed control (mel interpolation) and the HiFTGAN caching mechanisms for now.
+        # TODO jrm: ignoring the speed control (mel interpolation) for now.
+        # (whole-utterance vocoding; `inference_stream` carries the HiFT state across chunks with `StreamingHiFT`)
         hift_cache_source = torch.zeros(1, 1, 0).to(self.device)
 
         output_wavs, *_ = self.mel2wav.inference(speech_feat=output_mels, cache_source=hift_cache_source)
@@ -268,8 +359,11 @@ class S3Token2Wav(S3Token2Mel):
         # pre-computed ref embedding (prod API)
         ref_dict: Optional[dict] = None,
         finalize: bool = False,
+        solver: Optional[ODESolver] = None,
     ):
-        return super().forward(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        return super().forward(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize, solver=solver,
+        )
 
     @torch.inference_mode()
     def hift_inference(self, speech_feat, cache_source: torch.Tensor = None):
@@ -288,11 +382,93 @@ class S3Token2Wav(S3Token2Mel):
         ref_dict: Optional[dict] = None,
         cache_source: torch.Tensor = None, # NOTE: this arg is for streaming, it can probably be removed here
         finalize: bool = True,
+        solver: Optional[ODESolver] = None,
     ):
-        output_mels = self.flow_inference(speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize)
+        output_mels = self.flow_inference(
+            speech_tokens, ref_wav=ref_wav, ref_sr=ref_sr, ref_dict=ref_dict, finalize=finalize, solver=solver,
+        )
         output_wavs, output_sources = self.hift_inference(output_mels, cache_source)
 
         # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
         output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        speech_tokens: List[torch.Tensor],
+        ref_dicts: Union[dict, PromptCache, List[dict]],
+        solver: Optional[ODESolver] = None,
+    ) -> List[torch.Tensor]:
+        """
+        Batched `inference`: runs several 1D (valid) token sequences of different lengths through the flow in one
+        padded batch, each with its own ref dict (or all with the same one), then vocodes each at its own length.
+
+        Returns: the (1, samples) waveform of each sequence, trimmed to its length.
+        """
+        output_mels, mel_lens = self.forward_batch(speech_tokens, ref_dicts, finalize=True, solver=solver)
+        output_wavs, _ = self.mel2wav.inference(
+            speech_feat=output_mels,
+            cache_source=torch.zeros(1, 1, 0, device=self.device),
+            speech_feat_len=mel_lens,
+        )
+
+        # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+        output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
+
+        wav_lens = (mel_lens * self.mel2wav.samples_per_frame).tolist()
+        return [wav[None, :n] for wav, n in zip(output_wavs, wav_lens)]
+
+    @torch.inference_mode()
+    def inference_stream(
+        self,
+        speech_token_chunks: Iterable[torch.Tensor],
+        ref_dict: Union[dict, PromptCache],
+        mel_cache_len: Optional[int] = None,
+        solver: Optional[ODESolver] = None,
+        context_frames: int = 34,
+    ) -> Iterator[torch.Tensor]:
+        """
+        Streaming version of `inference`: consumes chunks of (valid) S3 speech tokens as they are produced, eg by
+        `T3.inference_stream`, and yields (1, samples) waveform chunks.
+
+        The flow only encodes and generates the new tokens of every chunk, conditioned on the last `context_frames`
+        generated mel frames (see `CausalMaskedDiffWithXvec.inference_chunk`), so a chunk costs the same at the end
+        of a long utterance as at its start. It holds back the last `pre_lookahead_len` tokens until more context
+        arrives. `ref_dict` can also be a `PromptCache`, otherwise its prompt is encoded once up front.
+
+        The mels go through a `StreamingHiFT`, which holds back the last `mel_cache_len` frames as vocoder lookahead
+        (by default the decoder's receptive field, see `min_margins`) and carries the NSF source and the conv context
+        over, so there is no glitch at the seams. Once the chunks run out, a final `finalize=True` pass flushes the
+        rest.
+        """
+        vocoder = StreamingHiFT(self.mel2wav, lookahead_frames=mel_cache_len)
+        # the flow holds back `pre_lookahead_len` tokens, and the vocoder another `lookahead_frames` frames
+        min_tokens = self.flow.pre_lookahead_len + vocoder.lookahead_frames // self.flow.token_mel_ratio + 1
+
+        if not isinstance(ref_dict, PromptCache):
+            ref_dict = self.prepare_prompt_cache(ref_dict)
+        flow_state = self.flow.start_stream(ref_dict, context_frames=context_frames)
+        tokens = torch.zeros(1, 0, dtype=torch.long, device=self.device)  # not yet sent to the flow
+        trim_fade_pos = 0
+
+        def token2wav(finalize):
+            nonlocal tokens, flow_state, trim_fade_pos
+            mels, flow_state = self.flow.inference_chunk(tokens, flow_state, finalize=finalize, solver=solver)
+            tokens = tokens[:, :0]
+            wav = vocoder.push(mels, final=finalize)
+
+            # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+            n = max(0, min(len(self.trim_fade) - trim_fade_pos, wav.size(1)))
+            wav[:, :n] *= self.trim_fade[trim_fade_pos:trim_fade_pos + n]
+            trim_fade_pos += wav.size(1)
+            return wav
+
+        for chunk in speech_token_chunks:
+            tokens = torch.cat([tokens, chunk.view(1, -1).to(tokens)], dim=1)
+            if tokens.size(1) >= min_tokens:
+                yield token2wav(finalize=False)
+
+        if tokens.size(1) > 0 or flow_state.num_generated > 0:
+            yield token2wav(finalize=True)
@@ -15,7 +15,8 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 
 import torch
 from torch import nn
@@ -96,6 +97,40 @@ class PreLookaheadLayer(nn.Module):
         return outputs
 
 
+@dataclass
+class EncoderChunkCache:
+    """
+    State of `UpsampleConformerEncoder.forward_chunk` after the tokens encoded so far: the first `offset` tokens are
+    final (encoded and attendable), the rest are pending, waiting for their `pre_lookahead_len` lookahead.
+
+    - `tail`: embedded inputs of the last 2 final tokens (the left context of the lookahead conv) and the pending
+      ones, (B, <= 2 + pending, D)
+    - `up_context`: first-stack outputs of the last 2 final tokens (the left context of `up_layer`), (B, <= 2, D)
+    - `att_caches` / `up_att_caches`: per layer keys / values of the final tokens, (B, head, offset (x2), d_k * 2)
+    """
+    offset: int
+    tail: torch.Tensor
+    up_context: torch.Tensor
+    att_caches: List[torch.Tensor]
+    up_att_caches: List[torch.Tensor]
+
+    @property
+    def num_pending(self):
+        return self.tail.size(1) - min(2, self.offset)
+
+    def expand(self, batch_size: int) -> "EncoderChunkCache":
+        "The cache of a single sequence, shared by `batch_size` continuations (a view, no copy)."
+        assert self.tail.size(0) == 1 or self.tail.size(0) == batch_size
+        expand = lambda x: x.expand(batch_size, *x.shape[1:])
+        return EncoderChunkCache(
+            offset=self.offset,
+            tail=expand(self.tail),
+            up_context=expand(self.up_context),
+            att_caches=[expand(c) for c in self.att_caches],
+            up_att_caches=[expand(c) for c in self.up_att_caches],
+        )
+
+
 class UpsampleConformerEncoder(torch.nn.Module):
 
     def __init__(
@@ -277,7 +312,8 @@ class UpsampleConformerEncoder(torch.nn.Module):
                                               self.static_chunk_size,
                                               num_decoding_left_chunks)
         # lookahead + conformer encoder
-        xs = self.pre_lookahead_layer(xs)
+        # (zero the padding first, so padded rows look ahead into zeros like unpadded ones)
+        xs = self.pre_lookahead_layer(xs * mask_pad.transpose(1, 2))
         xs = self.forward_layers(xs, chunk_masks, pos_emb, mask_pad)
 
         # upsample + conformer encoder
@@ -303,6 +339,100 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        xs_lens: Optional[torch.Tensor] = None,
+        cache: Optional[EncoderChunkCache] = None,
+        final: bool = False,
+    ) -> Tuple[torch.Tensor, EncoderChunkCache]:
+        """Encodes the next chunk of a sequence, reusing the attention and conv context of the previous ones.
+
+        Tokens become final once their lookahead is known (all of them with `final`); every chunk returns the
+        (upsampled) encodings of the tokens it makes final, and they attend to all the final tokens before them,
+        but not the other way around (ie chunk-causal attention, which the streaming flow is trained for). One
+        chunk with `final` and no cache gives the same result as `forward`.
+
+        Args:
+            xs: next token embeddings (B, T, D), right-padded when `xs_lens` (B,) is given, which is only allowed
+                for the `final` chunk
+            cache: the cache of the previous chunks, None for the first one; it is not modified
+            final: no more tokens follow, the lookahead of the last tokens is zero-padded
+        Returns:
+            encoder output of the newly final tokens (B, 2 * T', D), and the cache for the next chunk
+        """
+        assert xs_lens is None or final, "padded chunks are only supported at the end"
+        B, n_ctx = xs.size(0), 2
+        device = xs.device
+        if xs_lens is None:
+            xs_lens = torch.full((B,), xs.size(1), dtype=torch.long, device=device)
+        masks = ~make_pad_mask(xs_lens, xs.size(1)).unsqueeze(1)  # (B, 1, T)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, masks = self.embed(xs, masks)
+        xs = xs * masks.transpose(1, 2)
+        if cache is None:
+            cache = EncoderChunkCache(
+                offset=0,
+                tail=xs[:, :0],
+                up_context=xs[:, :0],
+                att_caches=[None] * len(self.encoders),
+                up_att_caches=[None] * len(self.up_encoders),
+            )
+        offset, num_ctx = cache.offset, min(n_ctx, cache.offset)
+        num_pending = cache.num_pending
+
+        # lookahead: every token now known, after the left context and the pending tokens of the last chunk
+        xs = torch.cat([cache.tail, xs], dim=1)
+        lookahead = self.pre_lookahead_layer.pre_lookahead_len
+        num_final = xs.size(1) - num_ctx if final else max(0, xs.size(1) - num_ctx - lookahead)
+        tail = xs[:, max(0, num_ctx + num_final - n_ctx):]
+        if num_final == 0:
+            empty = xs.new_zeros(B, 0, xs.size(2))
+            return empty, EncoderChunkCache(offset, tail, cache.up_context, cache.att_caches, cache.up_att_caches)
+        ys = self.pre_lookahead_layer(xs)[:, num_ctx:num_ctx + num_final]
+        valid = torch.cat([
+            torch.ones(B, 1, num_pending, dtype=torch.bool, device=device), masks,
+        ], dim=2)[:, :, :num_final]
+
+        # conformer encoder, on the final tokens
+        ys, att_caches = self._forward_layers_chunk(self.encoders, self.embed, ys, valid, offset, cache.att_caches)
+
+        # upsample + conformer encoder
+        up_in = torch.cat([cache.up_context, ys], dim=1).transpose(1, 2)
+        up_out, _ = self.up_layer(up_in, xs_lens)
+        up_out = up_out[:, :, self.up_layer.stride * cache.up_context.size(1):].transpose(1, 2).contiguous()
+        up_context = torch.cat([cache.up_context, ys], dim=1)[:, -n_ctx:]
+        up_valid = valid.repeat_interleave(self.up_layer.stride, dim=2)
+        up_out, _, _ = self.up_embed(up_out, up_valid)
+        up_out, up_att_caches = self._forward_layers_chunk(
+            self.up_encoders, self.up_embed, up_out, up_valid, offset * self.up_layer.stride, cache.up_att_caches
+        )
+        if self.normalize_before:
+            up_out = self.after_norm(up_out)
+
+        return up_out, EncoderChunkCache(
+            offset=offset + num_final,
+            tail=tail,
+            up_context=up_context,
+            att_caches=att_caches,
+            up_att_caches=up_att_caches,
+        )
+
+    @staticmethod
+    def _forward_layers_chunk(layers, embed, xs, valid, offset, att_caches):
+        "Runs `layers` on the chunk `xs` at `offset`, attending to the cached keys / values and the `valid` frames."
+        B, T = xs.size(0), xs.size(1)
+        masks = torch.cat([torch.ones(B, 1, offset, dtype=torch.bool, device=xs.device), valid], dim=2)
+        pos_emb = embed.position_encoding(offset=0, size=offset + T)
+        new_caches = []
+        for layer, att_cache in zip(layers, att_caches):
+            if att_cache is None:
+                att_cache = torch.zeros((0, 0, 0, 0), device=xs.device, dtype=xs.dtype)
+            xs, _, new_cache, _ = layer(xs, masks, pos_emb, att_cache=att_cache)
+            new_caches.append(new_cache)
+        return xs, new_caches
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
@@ -1,7 +1,9 @@
 # Copyright (c) 2025 Resemble AI
 # Author: John Meade, Jeremy Hsu
 # MIT License
+import copy
 import logging
+from contextlib import contextmanager
 import torch
 from dataclasses import dataclass
 from types import MethodType
@@ -26,6 +28,88 @@ class AlignmentAnalysisResult:
     position: int
 
 
+class AttentionSpy:
+    """
+    Captures the (head-averaged) attention weights of a single backbone layer.
+
+    Using `output_attentions=True` is incompatible with optimized attention kernels, so using it for all layers
+    slows things down too much. We can apply it to just one layer by intercepting the kwargs and adding a forward
+    hook (credit: jrm)
+    """
+
+    def __init__(self, tfmr, layer_idx):
+        # (B, T_query, T_key) attention of the last forward, kept on the device
+        self.last_attn = None
+        # off during forwards whose attention must not replace `last_attn` (see `paused`)
+        self.enabled = True
+        spy = self
+
+        def attention_forward_hook(module, input, output):
+            """
+            See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
+            NOTE:
+            - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
+            - `attn_weights` has shape [B, H, T0, T0] for the prefill, and [B, H, 1, T0+i] for the rest i-th.
+            """
+            if spy.enabled:
+                spy.last_attn = output[1].mean(dim=1)
+
+        target_layer = tfmr.layers[layer_idx].self_attn
+        self._hook_handle = target_layer.register_forward_hook(attention_forward_hook)
+
+        # Backup original forward
+        original_forward = target_layer.forward
+        def patched_forward(self, *args, **kwargs):
+            if not spy.enabled:
+                return original_forward(*args, **kwargs)
+            kwargs['output_attentions'] = True
+            # NOTE: `LlamaModel` drops the causal mask when SDPA can infer it (no padding, no static cache), but the
+            # eager attention we fall back to here can't, which would make this layer non-causal on the prefill
+            hidden_states = kwargs["hidden_states"] if "hidden_states" in kwargs else args[0]
+            if kwargs.get("attention_mask") is None and hidden_states.size(1) > 1:
+                kwargs["attention_mask"] = _causal_mask(hidden_states)
+            return original_forward(*args, **kwargs)
+
+        target_layer.forward = MethodType(patched_forward, target_layer)
+        target_layer.attention_spy = self
+        self._target_layer = target_layer
+
+    @staticmethod
+    @contextmanager
+    def paused(tfmr):
+        """
+        Stops the spies installed on `tfmr` from recording, eg during the uncond catch-up forwards of CFG
+        intervals, which would otherwise replace the attention of the cond rows the analyzers read.
+        """
+        spies = [layer.self_attn.attention_spy for layer in tfmr.layers if hasattr(layer.self_attn, "attention_spy")]
+        for spy in spies:
+            spy.enabled = False
+        try:
+            yield
+        finally:
+            for spy in spies:
+                spy.enabled = True
+
+    def close(self):
+        """
+        Removes the spy, so the target layer goes back to the fused SDPA kernel.
+        """
+        if self._target_layer is None:
+            return
+        self._hook_handle.remove()
+        del self._target_layer.forward  # drop the instance override, restoring the class method
+        del self._target_layer.attention_spy
+        self._target_layer = None
+
+
+def _causal_mask(hidden_states):
+    "Additive (1, 1, T, T) causal mask for a prefill without a cache."
+    T = hidden_states.size(1)
+    mask = torch.full((T, T), torch.finfo(hidden_states.dtype).min, dtype=hidden_states.dtype,
+                      device=hidden_states.device)
+    return mask.triu(diagonal=1)[None, None]
+
+
 class AlignmentStreamAnalyzer:
     def __init__(self, tfmr, queue, text_tokens_slice, alignment_layer_idx=9, eos_idx=0):
         """
@@ -35,6 +119,8 @@ class AlignmentStreamAnalyzer:
         position, repetition, etc.
 
         NOTE: currently requires no queues.
+        NOTE: with `tfmr=None` no hook is installed, and the attention has to be passed to `step` (see
+        `BatchAlignmentAnalyzer`).
         """
         # self.queue = queue
         self.text_tokens_slice = (i, j) = text_tokens_slice
@@ -50,55 +136,49 @@ class AlignmentStreamAnalyzer:
         self.complete = False
         self.completed_at = None
 
-        # Using `output_attentions=True` is incompatible with optimized attention kernels, so
-        # using it for all layers slows things down too much. We can apply it to just one layer
-        # by intercepting the kwargs and adding a forward hook (credit: jrm)
-        self.last_aligned_attn = None
-        self._add_attention_spy(tfmr, alignment_layer_idx)
+        # frame at which an EOS was forced because of a long tail / repetition
+        self.forced_eos_at = None
 
-    def _add_attention_spy(self, tfmr, alignment_layer_idx):
-        """
-        Adds a forward hook to a specific attention layer to collect outputs.
-        Using `output_attentions=True` is incompatible with optimized attention kernels, so
-        using it for all layers slows things down too much.
-        (credit: jrm)
-        """
+        self.spy = None if tfmr is None else AttentionSpy(tfmr, alignment_layer_idx)
 
-        def attention_forward_hook(module, input, output):
-            """
-            See `LlamaAttention.forward`; the output is a 3-tuple: `attn_output, attn_weights, past_key_value`.
-            NOTE:
-            - When `output_attentions=True`, `LlamaSdpaAttention.forward` calls `LlamaAttention.forward`.
-            - `attn_output` has shape [B, H, T0, T0] for the 0th entry, and [B, H, 1, T0+i] for the rest i-th.
-            """
-            step_attention = output[1].cpu() # (B, 16, N, N)
-            self.last_aligned_attn = step_attention[0].mean(0) # (N, N)
+    @property
+    def coverage(self):
+        "Fraction of the text tokens the alignment has reached so far (1 once complete)."
+        S = self.alignment.size(1)
+        if self.complete or S <= 3:
+            return 1.0
+        return min(1.0, float(self.text_position) / (S - 3))
 
-        target_layer = tfmr.layers[alignment_layer_idx].self_attn
-        hook_handle = target_layer.register_forward_hook(attention_forward_hook)
+    @property
+    def last_aligned_attn(self):
+        return self.spy.last_attn[0]  # (N, N)
 
-        # Backup original forward
-        original_forward = target_layer.forward
-        def patched_forward(self, *args, **kwargs):
-            kwargs['output_attentions'] = True
-            return original_forward(*args, **kwargs)
-
-        # TODO: how to unpatch it?
-        target_layer.forward = MethodType(patched_forward, target_layer)
+    def close(self):
+        """
+        Removes the attention spy, so the target layer goes back to the fused SDPA kernel. Call this once the
+        generation being analyzed is done.
+        """
+        if self.spy is not None:
+            self.spy.close()
 
-    def step(self, logits):
+    def step(self, logits, A_chunk=None):
         """
         Emits an AlignmentAnalysisResult into the output queue, and potentially modifies the logits to force an EOS.
+
+        `A_chunk` is the attention of the new frames over the text tokens, (T, S); by default it is read off the
+        attention spy.
         """
-        # extract approximate alignment matrix chunk (1 frame at a time after the first chunk)
-        aligned_attn = self.last_aligned_attn # (N, N)
-        i, j = self.text_tokens_slice
-        if self.curr_frame_pos == 0:
-            # first chunk has conditioning info, text tokens, and BOS token
-            A_chunk = aligned_attn[j:, i:j].clone().cpu() # (T, S)
-        else:
-            # subsequent chunks have 1 frame due to KV-caching
-            A_chunk = aligned_attn[:, i:j].clone().cpu() # (1, S)
+        if A_chunk is None:
+            # extract approximate alignment matrix chunk (1 frame at a time after the first chunk)
+            aligned_attn = self.last_aligned_attn # (N, N)
+            i, j = self.text_tokens_slice
+            if self.curr_frame_pos == 0:
+                # first chunk has conditioning info, text tokens, and BOS token
+                A_chunk = aligned_attn[j:, i:j] # (T, S)
+            else:
+                # subsequent chunks have 1 frame due to KV-caching
+                A_chunk = aligned_attn[:, i:j] # (1, S)
+        A_chunk = A_chunk.float().cpu().clone()
 
         # TODO: monotonic masking; could have issue b/c spaces are often skipped.
         A_chunk[:, self.curr_frame_pos + 1:] = 0
@@ -142,6 +222,8 @@ class AlignmentStreamAnalyzer:
         # NOTE: this means logits may be inconsistent with latents!
         if long_tail or repetition:
             logger.warn(f"forcing EOS token, {long_tail=}, {repetition=}")
+            if self.forced_eos_at is None:
+                self.forced_eos_at = T
             # (±2**15 is safe for all dtypes >= 16bit)
             logits = -(2**15) * torch.ones_like(logits)
             logits[..., self.eos_idx] = 2**15
@@ -152,3 +234,88 @@ class AlignmentStreamAnalyzer:
 
         self.curr_frame_pos += 1
         return logits
+
+
+class BatchAlignmentAnalyzer:
+    """
+    Runs one `AlignmentStreamAnalyzer` per request of a `T3DecodeBatch`, sharing a single `AttentionSpy`.
+
+    Cache slots shift as requests join / leave the batch, but the newest token of every row always sits in the last
+    filled slot (see `T3DecodeBatch`), so the text tokens of a request are located by their distance from that
+    slot, which only grows by one per step.
+    """
+
+    def __init__(self, tfmr, alignment_layer_idx=9, eos_idx=0):
+        self.spy = AttentionSpy(tfmr, alignment_layer_idx)
+        self.eos_idx = eos_idx
+        self.analyzers = {}
+        # request id -> distances of the first / one-past-last text token from the end of the prompt
+        self.text_offsets = {}
+
+    def add(self, request_id, num_text_tokens, num_bos=1):
+        """
+        Registers a request whose prompt ends with `[text, BOS]` (`num_text_tokens` including start / stop tokens,
+        and `num_bos` is 2 with CFG).
+        """
+        self.analyzers[request_id] = AlignmentStreamAnalyzer(
+            None, None, (0, num_text_tokens), eos_idx=self.eos_idx,
+        )
+        self.text_offsets[request_id] = (num_text_tokens + num_bos, num_bos)
+
+    def step(self, batch, logits):
+        """
+        Analyzes the attention of the forward pass that produced `logits` (N, V) for `batch` (a prefill or a decode
+        step), forcing or suppressing EOS in the logits of each request as needed.
+        """
+        attn = self.spy.last_attn  # (R, T_query, T_key)
+        end = batch.seq_len
+        for req_idx, request_id in enumerate(batch.request_ids):
+            analyzer = self.analyzers.get(request_id)
+            if analyzer is None:
+                continue
+            dist_i, dist_j = self.text_offsets[request_id]
+            start = end - analyzer.curr_frame_pos - dist_i
+            stop = end - analyzer.curr_frame_pos - dist_j
+            # the cond row of a request has the same index as the request
+            if analyzer.curr_frame_pos == 0:
+                A_chunk = attn[req_idx, -dist_j:, start:stop]  # BOS frames of the prefill
+            else:
+                A_chunk = attn[req_idx, -1:, start:stop]
+            logits[req_idx] = analyzer.step(logits[req_idx], A_chunk)
+        return logits
+
+    def get(self, request_id):
+        "The `AlignmentStreamAnalyzer` of `request_id`, if it is tracked."
+        return self.analyzers.get(request_id)
+
+    def repeat_requests(self, num_copies):
+        """
+        Replaces every tracked request with `num_copies` copies of its analysis state, renumbered like
+        `T3DecodeBatch.repeat_requests` does (request `r` becomes `r * num_copies + c`), for requests forked from the
+        same prompt. All the states are taken before any is written, since the new ids overlap the old ones.
+        """
+        entries = [(request_id, self.analyzers[request_id], self.text_offsets[request_id])
+                   for request_id in self.analyzers]
+        self.analyzers, self.text_offsets = {}, {}
+        for request_id, analyzer, text_offsets in entries:
+            for c in range(num_copies):
+                new_id = request_id * num_copies + c
+                self.analyzers[new_id] = copy.deepcopy(analyzer)
+                self.text_offsets[new_id] = text_offsets
+
+    def finish(self, request_id, num_generated, max_new_tokens):
+        """
+        Stops tracking `request_id`, which retired after `num_generated` tokens.
+
+        Returns: the number of decode steps saved by forcing an EOS, ie what was left of `max_new_tokens`.
+        """
+        self.text_offsets.pop(request_id)
+        analyzer = self.analyzers.pop(request_id)
+        if analyzer.forced_eos_at is None:
+            return 0
+        tokens_saved = max(0, max_new_tokens - num_generated)
+        logger.info(f"request {request_id}: forced EOS after {num_generated} tokens, saved {tokens_saved} tokens")
+        return tokens_saved
+
+    def close(self):
+        self.spy.close()
@@ -0,0 +1,65 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+import math
+import statistics
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from torch import Tensor
+
+from .alignment_stream_analyzer import AlignmentStreamAnalyzer
+
+
+@dataclass
+class CandidateScore:
+    """
+    Cheap quality signals of one sampled speech-token sequence, used to pick the best of several candidates
+    (`num_return_sequences`) without running S3Gen on all of them.
+    """
+    num_tokens: int
+    # False when the candidate ran out of tokens instead of ending on its own
+    emitted_eos: bool
+    # length relative to the median candidate length; outliers are usually truncated or have hallucinated tails
+    length_ratio: float = 1.0
+    # fraction of the text the attention alignment reached, with alignment analysis
+    alignment_coverage: Optional[float] = None
+    # whether the alignment analyzer had to force an EOS (long tail / repetition)
+    forced_eos: bool = False
+
+    @property
+    def score(self):
+        "Higher is better; 0 for a candidate with no detected problem."
+        score = -abs(math.log(max(self.length_ratio, 1e-3)))
+        if not self.emitted_eos:
+            score -= 2.0
+        if self.alignment_coverage is not None:
+            score -= 2.0 * (1.0 - self.alignment_coverage)
+        if self.forced_eos:
+            score -= 1.0
+        return score
+
+
+def select_candidate(
+    candidates: List[Tensor],
+    eos_token: int,
+    alignments: Optional[List[Optional[AlignmentStreamAnalyzer]]] = None,
+) -> Tuple[int, List[CandidateScore]]:
+    """
+    Args:
+        candidates: 1D speech tokens of each candidate, including the final EOS token when it was emitted
+        alignments: the finished `AlignmentStreamAnalyzer` of each candidate, if alignment analysis was on
+    Returns: the index of the best candidate, and the scores of all of them
+    """
+    alignments = alignments or [None] * len(candidates)
+    median_len = max(1.0, statistics.median(c.numel() for c in candidates))
+    scores = []
+    for tokens, analyzer in zip(candidates, alignments):
+        scores.append(CandidateScore(
+            num_tokens=tokens.numel(),
+            emitted_eos=tokens.numel() > 0 and int(tokens[-1]) == eos_token,
+            length_ratio=tokens.numel() / median_len,
+            alignment_coverage=None if analyzer is None else analyzer.coverage,
+            forced_eos=analyzer is not None and analyzer.forced_eos_at is not None,
+        ))
+    best = max(range(len(candidates)), key=lambda i: scores[i].score)
+    return best, scores
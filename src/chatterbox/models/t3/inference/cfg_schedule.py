@@ -0,0 +1,96 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+from torch import Tensor
+
+
+@dataclass
+class CFGSchedule:
+    """
+    When to run the unconditional CFG rows during decoding. By default, every step is guided.
+
+    - `max_guided_tokens`: guide only the first K tokens of each request
+    - `interval`: run the uncond rows only every n-th step, reusing the last `logits_cond - logits_uncond` delta
+      in between. The uncond rows catch up on the tokens they missed in a single forward pass, so their context
+      stays exact. Requires a static KV cache.
+    - `convergence_threshold`: stop guiding a request once the total variation distance between its cond and
+      uncond distributions stays below this for `patience` guided steps
+
+    Requests that stop being guided have their uncond row dropped from the batch, along with its KV cache.
+    """
+    max_guided_tokens: Optional[int] = None
+    interval: int = 1
+    convergence_threshold: Optional[float] = None
+    patience: int = 3
+
+    def __post_init__(self):
+        assert self.interval >= 1, self.interval
+
+
+class CFGState:
+    """
+    Per-request CFG bookkeeping of a `T3DecodeBatch` following a `CFGSchedule`.
+    """
+
+    def __init__(
+        self,
+        schedule: CFGSchedule,
+        delta: Optional[Tensor],
+        converged_steps: Tensor,
+        uncond_lag: int = 0,
+    ):
+        self.schedule = schedule
+        self.delta = delta  # (N, V) last `logits_cond - logits_uncond`, zero for requests without an uncond row
+        self.converged_steps = converged_steps  # (N,) consecutive guided steps below the convergence threshold
+        self.uncond_lag = uncond_lag  # number of tokens the uncond rows are behind the cond rows
+
+    @classmethod
+    def create(cls, schedule: CFGSchedule, num_requests: int, device=None):
+        return cls(schedule, None, torch.zeros(num_requests, dtype=torch.long, device=device))
+
+    @property
+    def uses_interval(self):
+        return self.schedule.interval > 1
+
+    def is_guided_step(self):
+        "Whether the uncond rows should run on the next decode step."
+        return self.uncond_lag + 1 >= self.schedule.interval
+
+    def requests_to_drop(self, num_generated: List[int], has_uncond: List[bool], tv_distance: Optional[Tensor]):
+        """
+        Args:
+            num_generated: tokens sampled so far by each request
+            has_uncond: whether each request still has an uncond row
+            tv_distance: (N,) distance between the cond and uncond distributions, on guided steps
+        Returns: the indices of the requests that should stop being guided
+        """
+        schedule = self.schedule
+        drop = [False] * len(has_uncond)
+        if schedule.max_guided_tokens is not None:
+            drop = [n >= schedule.max_guided_tokens for n in num_generated]
+        if schedule.convergence_threshold is not None and tv_distance is not None:
+            converged = tv_distance < schedule.convergence_threshold
+            self.converged_steps = torch.where(converged, self.converged_steps + 1, 0)
+            drop = [d or bool(c) for d, c in zip(drop, (self.converged_steps >= schedule.patience).tolist())]
+        return [i for i, (d, u) in enumerate(zip(drop, has_uncond)) if d and u]
+
+    def select(self, reqs: Tensor):
+        return CFGState(
+            self.schedule,
+            None if self.delta is None else self.delta[reqs],
+            self.converged_steps[reqs],
+            self.uncond_lag,
+        )
+
+    @classmethod
+    def concatenate(cls, states: List["CFGState"]) -> "CFGState":
+        assert all(s.uncond_lag == 0 for s in states), "flush the uncond rows (`T3.flush_uncond`) before merging"
+        deltas = [s.delta for s in states]
+        return cls(
+            states[0].schedule,
+            None if any(d is None for d in deltas) else torch.cat(deltas),
+            torch.cat([s.converged_steps for s in states]),
+        )
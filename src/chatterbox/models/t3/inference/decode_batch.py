@@ -0,0 +1,349 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from transformers.cache_utils import Cache
+
+from .cfg_schedule import CFGState
+from .kv_cache import (
+    cache_capacity, is_paged_cache, is_static_cache, pad_cache_tensor, select_cache_rows, trim_cache_capacity,
+)
+from .paged_kv_cache import PagedKVCache
+from .sampler import T3Sampler
+
+
+def pad_left(seqs: List[Tensor]):
+    """
+    Left-pads a list of (len_i, dim) sequences so that the last element of every sequence lines up.
+
+    Returns:
+        padded: (B, max_len, dim)
+        mask: (B, max_len) long tensor, 1 for real positions and 0 for padding
+    """
+    max_len = max(s.size(0) for s in seqs)
+    ref = seqs[0]
+    padded = ref.new_zeros(len(seqs), max_len, *ref.shape[1:])
+    mask = torch.zeros(len(seqs), max_len, dtype=torch.long, device=ref.device)
+    for i, s in enumerate(seqs):
+        padded[i, max_len - s.size(0):] = s
+        mask[i, max_len - s.size(0):] = 1
+    return padded, mask
+
+
+@dataclass
+class T3DecodeBatch:
+    """
+    Decoding state for several independent T3 requests sharing one KV cache.
+
+    Rows are laid out as one conditional row per request, followed by one unconditional row for every request
+    that uses CFG (ie `2N` rows when all `N` requests use CFG). Rows are left-padded to a common length so the
+    newest token of every row always sits in the last filled cache slot.
+
+    With a `T3StaticCache`, the attention mask spans the whole cache capacity; slots past the filled length are
+    left at 1 and hidden by the causal mask until they are written.
+    """
+    past: Cache
+    # (R, L) 1 for real tokens, 0 for left padding; L is the cache capacity for static caches
+    attention_mask: Tensor
+    # (R,) RoPE position of the next input token of each row
+    position_ids: Tensor
+    # (R,) index of the request that owns each row
+    row_requests: List[int]
+    # (N,) CFG weight of each request (0 when the request has no uncond row)
+    cfg_weights: Tensor
+    # (N,) learned speech position of the next input token of each request
+    speech_positions: Tensor
+    # (N, C) pre-allocated buffer of sampled tokens; each request's tokens end at column `output_len`
+    output_ids: Tensor
+    output_len: int
+    # number of tokens sampled so far by each request
+    num_generated: List[int]
+    # sampling parameters and repetition-penalty histograms of each request
+    sampler: T3Sampler
+    # caller-side ids, so results can be matched up once requests retire
+    request_ids: List[int]
+    # CFG schedule bookkeeping, if the uncond rows don't run on every step
+    cfg_state: Optional[CFGState] = None
+
+    @property
+    def num_requests(self):
+        return len(self.request_ids)
+
+    @property
+    def num_rows(self):
+        return len(self.row_requests)
+
+    @property
+    def is_static(self):
+        return is_static_cache(self.past)
+
+    @property
+    def seq_len(self):
+        "Number of filled cache slots, ie the cache position of the next input token."
+        return self.past.get_seq_length()
+
+    @property
+    def uncond_rows(self) -> Tensor:
+        "(N,) index of each request's unconditional row, or -1 when it doesn't have one."
+        uncond_rows = [-1] * self.num_requests
+        for row in range(self.num_requests, self.num_rows):
+            uncond_rows[self.row_requests[row]] = row
+        return torch.tensor(uncond_rows, dtype=torch.long, device=self.cfg_weights.device)
+
+    @property
+    def has_uncond(self) -> List[bool]:
+        "Whether each request has an unconditional row."
+        has_uncond = [False] * self.num_requests
+        for req in self.row_requests[self.num_requests:]:
+            has_uncond[req] = True
+        return has_uncond
+
+    def apply_cfg(self, logits: Tensor) -> Tensor:
+        """
+        Combines per-row logits (R, V) into per-request logits (N, V):
+            `logits_cond + cfg_weight * (logits_cond - logits_uncond)`
+        Requests without an uncond row get a weight of zero, ie their cond logits pass through unchanged.
+        """
+        uncond_rows = self.uncond_rows
+        logits_cond = logits[:self.num_requests]
+        logits_uncond = logits[uncond_rows.clamp(min=0)]
+        delta = (logits_cond - logits_uncond) * (uncond_rows >= 0)[:, None]
+        if self.cfg_state is not None:
+            self.cfg_state.delta = delta
+        return logits_cond + self.cfg_weights[:, None].to(logits.dtype) * delta
+
+    def apply_cached_cfg(self, logits_cond: Tensor) -> Tensor:
+        "Like `apply_cfg`, for steps where the uncond rows didn't run: reuses the last CFG delta."
+        return logits_cond + self.cfg_weights[:, None].to(logits_cond.dtype) * self.cfg_state.delta
+
+    def drop_uncond(self, reqs: List[int]):
+        "Stops guiding the requests `reqs`: their uncond rows leave the batch, freeing their KV cache rows."
+        drop = set(reqs)
+        keep_rows = list(range(self.num_requests)) + [
+            row for row in range(self.num_requests, self.num_rows) if self.row_requests[row] not in drop
+        ]
+        rows = torch.tensor(keep_rows, dtype=torch.long, device=self.attention_mask.device)
+        self.past = select_cache_rows(self.past, rows)
+        self.attention_mask = self.attention_mask[rows]
+        self.position_ids = self.position_ids[rows]
+        self.row_requests = [self.row_requests[r] for r in keep_rows]
+        if self.cfg_state is not None and self.cfg_state.delta is not None:
+            self.cfg_state.delta[reqs] = 0
+        return self
+
+    def release(self):
+        "Returns the blocks of a `PagedKVCache` to its pool, once the batch is done (no-op for other caches)."
+        if is_paged_cache(self.past):
+            self.past.release()
+
+    def expand_to_rows(self, x: Tensor) -> Tensor:
+        "Maps a per-request tensor (N, ...) onto the row layout (R, ...)."
+        return x[torch.tensor(self.row_requests, dtype=torch.long, device=x.device)]
+
+    def append_tokens(self, next_tokens: Tensor):
+        "Records the tokens sampled for every request, shape (N, 1)."
+        if self.output_len == self.output_ids.size(1):
+            self.output_ids = F.pad(self.output_ids, (0, self.output_ids.size(1)))  # (rarely) grow x2
+        self.output_ids[:, self.output_len] = next_tokens[:, 0]
+        self.output_len += 1
+        self.num_generated = [n + 1 for n in self.num_generated]
+        self.sampler.update(next_tokens)
+
+    def get_generated(self, req_idx: int) -> Tensor:
+        "1D tensor of the tokens sampled so far by request `req_idx` (not including BOS)."
+        n = self.num_generated[req_idx]
+        return self.output_ids[req_idx, self.output_len - n:self.output_len].clone()
+
+    def filter(self, keep: List[int]):
+        """
+        Retires every request not in `keep` (sorted request indices), freeing its rows in the KV cache. Cache slots
+        that are padding for all of the remaining rows are dropped as well.
+        """
+        keep_set = set(keep)
+        remap = {old: new for new, old in enumerate(keep)}
+        keep_rows = [r for r, req in enumerate(self.row_requests) if req in keep_set]
+        rows = torch.tensor(keep_rows, dtype=torch.long, device=self.attention_mask.device)
+        reqs = torch.tensor(keep, dtype=torch.long, device=self.attention_mask.device)
+
+        attention_mask = self.attention_mask[rows]
+        # (the free slots of a static cache are 1 in the mask, so only leading padding is dropped)
+        start = int(attention_mask.any(dim=0).long().argmax())
+
+        self.past = select_cache_rows(self.past, rows, start)
+        self.attention_mask = attention_mask[:, start:]
+        self.position_ids = self.position_ids[rows]
+        self.row_requests = [remap[self.row_requests[r]] for r in keep_rows]
+        self.cfg_weights = self.cfg_weights[reqs]
+        self.speech_positions = self.speech_positions[reqs]
+        self.output_ids = self.output_ids[reqs]
+        self.num_generated = [self.num_generated[i] for i in keep]
+        self.sampler = self.sampler.select(reqs)
+        self.request_ids = [self.request_ids[i] for i in keep]
+        if self.cfg_state is not None:
+            self.cfg_state = self.cfg_state.select(reqs)
+        return self
+
+    def compact(self, max_new_tokens: List[int]):
+        """
+        Shrinks a static cache (and the token buffer) to what the remaining requests can still use, given the token
+        budget of each: after requests retire, the free slots were sized for their budgets. Without this, a
+        long-running batch that keeps admitting requests would grow with every admission.
+        """
+        remaining = max(m - n for m, n in zip(max_new_tokens, self.num_generated))
+        remaining = max(remaining, 1)
+        if self.is_static:
+            capacity = self.seq_len + remaining
+            self.past = trim_cache_capacity(self.past, capacity)
+            self.attention_mask = self.attention_mask[:, :capacity]
+        left = max(self.num_generated)
+        self.output_ids = self.output_ids[:, self.output_len - left:self.output_len + remaining]
+        self.output_len = left
+        return self
+
+    def repeat_requests(self, num_copies: int):
+        """
+        Forks every request into `num_copies` independent requests that share its prompt, eg to sample several
+        candidates off a single prefill. The copies of request `i` become requests `i * num_copies + c`, with request
+        ids `request_id * num_copies + c`.
+        """
+        N, k = self.num_requests, num_copies
+        keep_rows = [r for r in range(self.num_rows) for _ in range(k)]
+        row_requests = list(range(N * k)) + [
+            self.row_requests[r] * k + c for r in range(N, self.num_rows) for c in range(k)
+        ]
+        rows = torch.tensor(keep_rows, dtype=torch.long, device=self.attention_mask.device)
+        reqs = torch.arange(N, device=self.attention_mask.device).repeat_interleave(k)
+
+        self.past = select_cache_rows(self.past, rows)
+        self.attention_mask = self.attention_mask[rows]
+        self.position_ids = self.position_ids[rows]
+        self.row_requests = row_requests
+        self.cfg_weights = self.cfg_weights[reqs]
+        self.speech_positions = self.speech_positions[reqs]
+        self.output_ids = self.output_ids[reqs]
+        self.num_generated = [n for n in self.num_generated for _ in range(k)]
+        self.sampler = self.sampler.select(reqs)
+        self.request_ids = [request_id * k + c for request_id in self.request_ids for c in range(k)]
+        if self.cfg_state is not None:
+            self.cfg_state = self.cfg_state.select(reqs)
+        return self
+
+    @classmethod
+    def concatenate(cls, batches: List["T3DecodeBatch"]) -> "T3DecodeBatch":
+        """
+        Merges several batches into one by left-padding their KV caches to a common length. This is how new
+        requests are admitted into a running batch between decode steps. The input batches are consumed.
+        """
+        if len(batches) == 1:
+            return batches[0]
+        seq_len = max(b.seq_len for b in batches)
+        # static caches must keep the free slots they had, behind the shifted-in left padding (`compact` keeps
+        # those sized for the live requests)
+        capacity = max(cache_capacity(b.past) + seq_len - b.seq_len for b in batches)
+        output_len = max(b.output_len for b in batches)
+        output_capacity = max(b.output_ids.size(1) + output_len - b.output_len for b in batches)
+
+        def cat_rows(xs):
+            "Concatenates per-row tensors, keeping all cond rows ahead of all uncond rows."
+            cond = [x[:b.num_requests] for x, b in zip(xs, batches)]
+            uncond = [x[b.num_requests:] for x, b in zip(xs, batches)]
+            return torch.cat(cond + uncond)
+
+        def padding(b):
+            left = seq_len - b.seq_len
+            return left, capacity - cache_capacity(b.past) - left
+
+        if is_paged_cache(batches[0].past):
+            # stack the block tables, then move all the cond rows ahead of the uncond rows
+            past = PagedKVCache.concatenate([b.past for b in batches])
+            row_offsets = [sum(b.num_rows for b in batches[:i]) for i in range(len(batches))]
+            order = [o + r for o, b in zip(row_offsets, batches) for r in range(b.num_requests)]
+            order += [o + r for o, b in zip(row_offsets, batches) for r in range(b.num_requests, b.num_rows)]
+            past.select_rows(torch.tensor(order, dtype=torch.long, device=past.slot_mapping.device))
+        else:
+            past = batches[0].past
+            for layer_idx in range(len(past.key_cache)):
+                past.key_cache[layer_idx] = cat_rows([
+                    pad_cache_tensor(b.past.key_cache[layer_idx], *padding(b)) for b in batches
+                ])
+                past.value_cache[layer_idx] = cat_rows([
+                    pad_cache_tensor(b.past.value_cache[layer_idx], *padding(b)) for b in batches
+                ])
+        if is_static_cache(past):
+            past.max_cache_len = capacity
+            past.set_seq_length(seq_len)
+
+        row_requests_cond, row_requests_uncond = [], []
+        offset = 0
+        for b in batches:
+            row_requests_cond += [r + offset for r in b.row_requests[:b.num_requests]]
+            row_requests_uncond += [r + offset for r in b.row_requests[b.num_requests:]]
+            offset += b.num_requests
+
+        output_ids = []
+        for b in batches:
+            left = output_len - b.output_len
+            output_ids.append(F.pad(b.output_ids, (left, output_capacity - b.output_ids.size(1) - left)))
+
+        return cls(
+            past=past,
+            attention_mask=cat_rows([
+                F.pad(F.pad(b.attention_mask, (padding(b)[0], 0), value=0), (0, padding(b)[1]), value=1)
+                for b in batches
+            ]),
+            position_ids=cat_rows([b.position_ids for b in batches]),
+            row_requests=row_requests_cond + row_requests_uncond,
+            cfg_weights=torch.cat([b.cfg_weights for b in batches]),
+            speech_positions=torch.cat([b.speech_positions for b in batches]),
+            output_ids=torch.cat(output_ids),
+            output_len=output_len,
+            num_generated=sum((b.num_generated for b in batches), []),
+            sampler=T3Sampler.concatenate([b.sampler for b in batches]),
+            request_ids=sum((b.request_ids for b in batches), []),
+            cfg_state=(
+                None if any(b.cfg_state is None for b in batches)
+                else CFGState.concatenate([b.cfg_state for b in batches])
+            ),
+        )
+
+
+@dataclass
+class T3PendingPrefill:
+    """
+    A `T3DecodeBatch` whose prompts are being fed to the backbone in chunks (see `T3.start_prefill`), so a long
+    prompt never runs through the backbone in one piece and can be interleaved with decode steps of other batches.
+    """
+    # the batch being prefilled; its KV cache only holds the chunks fed so far
+    batch: T3DecodeBatch
+    # (R, L, dim) left-padded prompt embeddings, not counting a cached voice prefix
+    inputs_embeds: Tensor
+    # (R, L) RoPE positions of the prompt tokens
+    position_ids: Tensor
+    # length of the voice prefix copied into the cache ahead of the prompt
+    prefix_len: int
+    # [start, end) prompt offsets of each chunk
+    chunks: List[Tuple[int, int]]
+    next_chunk: int = 0
+
+    @staticmethod
+    def split(prompt_len: int, chunk_size: Optional[int]) -> List[Tuple[int, int]]:
+        """
+        Chunk boundaries for a prompt of `prompt_len` tokens. The remainder goes to the first chunk, which is mostly
+        left padding, so the last chunk (whose attention over the text is analyzed) always has `chunk_size` tokens.
+        """
+        if chunk_size is None or chunk_size >= prompt_len:
+            return [(0, prompt_len)]
+        ends = list(range(prompt_len, 0, -chunk_size))[::-1]
+        return list(zip([0] + ends[:-1], ends))
+
+    @property
+    def done(self):
+        return self.next_chunk == len(self.chunks)
+
+    @property
+    def num_rows(self):
+        return self.batch.num_rows
@@ -0,0 +1,111 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+import copy
+from typing import Any, Dict, Optional
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from transformers import LlamaConfig
+from transformers.cache_utils import Cache, StaticCache
+
+from .paged_kv_cache import PagedKVCache
+
+
+class T3StaticCache(StaticCache):
+    """
+    Pre-allocated KV cache for the T3 decode loop.
+
+    Keys / values of all layers are allocated once, sized for the prompt plus the token budget, and written in place
+    at `cache_position` instead of being grown by concatenation on every step. With the attention mask also kept at
+    full capacity, every decode step has the same input shapes, which is what `torch.compile` / CUDA graphs need.
+
+    Unlike `StaticCache`, the number of filled slots is tracked on the host so `get_seq_length` doesn't sync.
+    """
+
+    def __init__(self, config: LlamaConfig, max_batch_size: int, max_cache_len: int, device=None, dtype=torch.float32):
+        super().__init__(config, max_batch_size, max_cache_len, device, dtype)
+        self._seq_len = 0
+
+    def update(
+        self,
+        key_states: Tensor,
+        value_states: Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ):
+        if layer_idx == 0:
+            # NOTE: T3 always writes contiguously after the filled slots
+            self._seq_len += key_states.shape[-2]
+        return super().update(key_states, value_states, layer_idx, cache_kwargs)
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self._seq_len
+
+    def set_seq_length(self, seq_len: int):
+        self._seq_len = seq_len
+
+    def crop(self, max_length: int):
+        "Discards everything after the first `max_length` slots; they are masked out and overwritten later."
+        self._seq_len = min(self._seq_len, max_length)
+
+    def reset(self):
+        super().reset()
+        self._seq_len = 0
+
+
+def is_static_cache(past: Cache):
+    return isinstance(past, StaticCache)
+
+
+def is_paged_cache(past: Cache):
+    return isinstance(past, PagedKVCache)
+
+
+def cache_capacity(past: Cache) -> int:
+    "Number of slots allocated in `past`, which for dynamic / paged caches is just the filled length."
+    if is_paged_cache(past):
+        return past.get_seq_length()
+    return past.key_cache[0].size(2)
+
+
+def select_cache_rows(past: Cache, rows: Tensor, start: int = 0):
+    "Keep only `rows` of every layer in `past`, dropping the first `start` cache slots."
+    if is_paged_cache(past):
+        return past.select_rows(rows, start)
+    for layer_idx in range(len(past.key_cache)):
+        past.key_cache[layer_idx] = past.key_cache[layer_idx][rows, :, start:]
+        past.value_cache[layer_idx] = past.value_cache[layer_idx][rows, :, start:]
+    if is_static_cache(past) and start > 0:
+        past.max_cache_len -= start
+        past.set_seq_length(past.get_seq_length() - start)
+    return past
+
+
+def trim_cache_capacity(past: Cache, capacity: int):
+    "Frees the slots of a static cache past the first `capacity` (no-op for other caches)."
+    if not is_static_cache(past) or capacity >= past.max_cache_len:
+        return past
+    assert capacity >= past.get_seq_length(), "can't drop filled slots"
+    for layer_idx in range(len(past.key_cache)):
+        past.key_cache[layer_idx] = past.key_cache[layer_idx][:, :, :capacity].clone()
+        past.value_cache[layer_idx] = past.value_cache[layer_idx][:, :, :capacity].clone()
+    past.max_cache_len = capacity
+    return past
+
+
+def cache_row_view(past: Cache, rows: slice) -> Cache:
+    """
+    Shallow copy of the static cache `past` restricted to a contiguous range of rows, so a forward pass can run on
+    just those rows while writing to the original tensors in place. The caller keeps the filled length up to date.
+    """
+    assert is_static_cache(past), "only static caches are written in place"
+    view = copy.copy(past)
+    view.key_cache = [k[rows] for k in past.key_cache]
+    view.value_cache = [v[rows] for v in past.value_cache]
+    return view
+
+
+def pad_cache_tensor(x: Tensor, left: int, right: int) -> Tensor:
+    "Pads the sequence dim of a (B, H, L, D) cache tensor."
+    return F.pad(x, (0, 0, left, right))
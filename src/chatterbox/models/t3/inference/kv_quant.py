@@ -0,0 +1,19 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+import torch
+from torch import Tensor
+
+
+def quantize_int8(x: Tensor):
+    """
+    Symmetric absmax quantization of keys / values (..., D), with one scale per head vector.
+
+    Returns: the int8 tensor and the (..., 1) scales, `x ~= q * scale`.
+    """
+    scale = x.abs().amax(dim=-1, keepdim=True).float() / 127
+    q = (x.float() / scale.clamp(min=1e-8)).round_().clamp_(-127, 127).to(torch.int8)
+    return q, scale
+
+
+def dequantize_int8(q: Tensor, scale: Tensor) -> Tensor:
+    return q.to(scale.dtype) * scale
@@ -0,0 +1,103 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Hashable, List
+
+from torch import Tensor
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class VoicePrefix:
+    """
+    Backbone keys / values for the conditioning prefix of one voice (speaker projection, perceiver tokens and the
+    emotion_adv token from `T3CondEnc`), as produced by `T3.compute_prefix_kv`.
+    """
+    keys: List[Tensor]  # per layer, (1, H, len, D)
+    values: List[Tensor]  # per layer, (1, H, len, D)
+
+    @property
+    def length(self):
+        return self.keys[0].size(2)
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.keys + self.values)
+
+
+class VoicePrefixCache:
+    """
+    LRU cache of `VoicePrefix` KV tensors, so requests for a known voice only prefill their text + BOS tokens.
+
+    Entries are keyed by `(voice_id, exaggeration)`. CFG on/off doesn't need its own entry: the unconditional row
+    only zeroes the text embeddings, so both rows share the same conditioning prefix.
+
+    NOTE: the caller is responsible for `voice_id` uniquely identifying the conditionals (speaker embedding and
+    prompt speech tokens), otherwise a request would be generated with another voice's prefix.
+    """
+
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Hashable, VoicePrefix]" = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(voice_id: Hashable, exaggeration: float):
+        return voice_id, round(float(exaggeration), 4)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get_or_compute(self, key: Hashable, compute_fn: Callable[[], VoicePrefix]) -> VoicePrefix:
+        with self.lock:
+            prefix = self.entries.get(key)
+            if prefix is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return prefix
+            self.misses += 1
+
+        prefix = compute_fn()
+        self.put(key, prefix)
+        return prefix
+
+    def put(self, key: Hashable, prefix: VoicePrefix):
+        if prefix.nbytes > self.max_bytes:
+            logger.warning(f"voice prefix ({prefix.nbytes} bytes) exceeds the cache capacity, not caching it")
+            return
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key).nbytes
+            self.entries[key] = prefix
+            self.nbytes += prefix.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return dict(
+            entries=len(self.entries),
+            nbytes=self.nbytes,
+            max_bytes=self.max_bytes,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+        )
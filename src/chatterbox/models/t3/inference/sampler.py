@@ -0,0 +1,152 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+from dataclasses import dataclass
+from typing import List
+
+import torch
+from torch import Tensor
+
+
+@dataclass
+class SamplingParams:
+    "Per-request sampling settings for `T3Sampler`."
+    temperature: float = 0.8
+    min_p: float = 0.05
+    top_p: float = 1.00
+    repetition_penalty: float = 1.2
+
+
+class T3Sampler:
+    """
+    Fused replacement for the HF `RepetitionPenaltyLogitsProcessor` -> `MinPLogitsWarper` -> `TopPLogitsWarper`
+    chain used to sample T3 speech tokens.
+
+    - the repetition penalty reads a per-row token-count histogram that is updated in place, instead of gathering
+      over a `generated_ids` tensor that grows on every step
+    - logits are restricted to the valid speech tokens plus `stop_speech_token`, so the start token and the unused
+      tail of the 8194-way vocab can never be sampled
+    - min-p is applied first, and top-p only ranks the tokens that survived it, which avoids sorting the full
+      vocab unless min-p is disabled
+    - every parameter is a per-row tensor, so requests with different settings can share one batch
+    - sampling is an exponential race, which stays on the device (no host sync)
+
+    The processing order (temperature, repetition penalty, min-p, top-p) matches the original HF chain.
+    """
+
+    def __init__(
+        self,
+        *,
+        temperature: Tensor,
+        min_p: Tensor,
+        top_p: Tensor,
+        repetition_penalty: Tensor,
+        token_counts: Tensor,
+        start_token: int,
+    ):
+        self.temperature = temperature  # (N,)
+        self.min_p = min_p  # (N,)
+        self.top_p = top_p  # (N,)
+        self.repetition_penalty = repetition_penalty  # (N,)
+        self.token_counts = token_counts  # (N, V') number of times each token was sampled
+        self.start_token = start_token
+        self.use_top_p = bool((top_p < 1.0).any())
+
+    @classmethod
+    def create(cls, params: List[SamplingParams], *, start_token: int, stop_token: int, device=None):
+        """
+        Args:
+            params: one `SamplingParams` per row
+            start_token / stop_token: the start / stop speech tokens; the valid vocab is `[0, stop_token]`
+                without `start_token`.
+        """
+        def param(name):
+            return torch.tensor([getattr(p, name) for p in params], dtype=torch.float, device=device)
+
+        return cls(
+            temperature=param("temperature"),
+            min_p=param("min_p"),
+            top_p=param("top_p"),
+            repetition_penalty=param("repetition_penalty"),
+            token_counts=torch.zeros(len(params), stop_token + 1, dtype=torch.int32, device=device),
+            start_token=start_token,
+        )
+
+    @property
+    def vocab_size(self):
+        return self.token_counts.size(1)
+
+    @torch.inference_mode()
+    def __call__(self, logits: Tensor) -> Tensor:
+        """
+        Args:
+            logits: (N, V) raw (CFG-combined) logits, V >= `vocab_size`
+        Returns:
+            (N, 1) sampled tokens
+        """
+        return self.sample(self.probs(logits))
+
+    @torch.inference_mode()
+    def probs(self, logits: Tensor) -> Tensor:
+        """
+        The distribution `__call__` samples from, as (N, `vocab_size`) probabilities that aren't renormalized after
+        min-p / top-p.
+        """
+        # temperature
+        logits = logits[:, :self.vocab_size].float() / self.temperature[:, None]
+        logits[:, self.start_token] = -float("inf")
+
+        # repetition penalty, applied once to every token sampled so far
+        penalty = self.repetition_penalty[:, None]
+        penalized = torch.where(logits < 0, logits * penalty, logits / penalty)
+        logits = torch.where(self.token_counts > 0, penalized, logits)
+
+        # min-p: drop tokens less likely than `min_p` times the most likely one
+        probs = logits.softmax(dim=-1)
+        probs.masked_fill_(probs < self.min_p[:, None] * probs.amax(dim=-1, keepdim=True), 0)
+
+        # top-p, ranking only the tokens that survived min-p
+        if self.use_top_p:
+            probs = self._top_p(probs)
+        return probs
+
+    @staticmethod
+    def sample(probs: Tensor) -> Tensor:
+        "(N, 1) tokens sampled from (N, V) probabilities, which don't need to be normalized."
+        # argmax(p / Exp(1)) is distributed as Categorical(p)
+        noise = torch.empty_like(probs).exponential_()
+        return (probs / noise).argmax(dim=-1, keepdim=True)
+
+    def _top_p(self, probs: Tensor) -> Tensor:
+        k = int((probs > 0).sum(dim=-1).max())
+        top_probs, top_idx = probs.topk(k, dim=-1)  # sorted descending
+        mass_before = top_probs.cumsum(dim=-1) - top_probs
+        total = probs.sum(dim=-1, keepdim=True)
+        keep = mass_before < self.top_p[:, None] * total
+        keep[:, 0] = True
+        return torch.zeros_like(probs).scatter_(1, top_idx, top_probs * keep)
+
+    def update(self, next_tokens: Tensor):
+        "Adds the sampled tokens (N, 1) to the histogram."
+        self.token_counts.scatter_add_(1, next_tokens, torch.ones_like(next_tokens, dtype=self.token_counts.dtype))
+
+    def select(self, rows: Tensor):
+        "Keeps only `rows` (eg when requests retire from a batch)."
+        return T3Sampler(
+            temperature=self.temperature[rows],
+            min_p=self.min_p[rows],
+            top_p=self.top_p[rows],
+            repetition_penalty=self.repetition_penalty[rows],
+            token_counts=self.token_counts[rows],
+            start_token=self.start_token,
+        )
+
+    @classmethod
+    def concatenate(cls, samplers: List["T3Sampler"]) -> "T3Sampler":
+        return cls(
+            temperature=torch.cat([s.temperature for s in samplers]),
+            min_p=torch.cat([s.min_p for s in samplers]),
+            top_p=torch.cat([s.top_p for s in samplers]),
+            repetition_penalty=torch.cat([s.repetition_penalty for s in samplers]),
+            token_counts=torch.cat([s.token_counts for s in samplers]),
+            start_token=samplers[0].start_token,
+        )
@@ -0,0 +1,335 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+import itertools
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Hashable, List, Optional
+
+import torch
+from torch import Tensor
+
+from ..modules.cond_enc import T3Cond
+from .alignment_stream_analyzer import BatchAlignmentAnalyzer
+from .cfg_schedule import CFGSchedule
+from .decode_batch import T3DecodeBatch, T3PendingPrefill
+from .paged_kv_cache import KVBlockPool
+from .prefix_cache import VoicePrefixCache
+from .sampler import SamplingParams
+from .token_budget import TokenBudgetEstimator
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class T3Request:
+    """
+    A single speech-token generation request for the `T3Scheduler`.
+    """
+    t3_cond: T3Cond
+    # 1D text tokens, including start / stop text tokens
+    text_tokens: Tensor
+    cfg_weight: float = 0.5
+    # defaults to the scheduler's token budget estimate
+    max_new_tokens: Optional[int] = None
+    # defaults to the scheduler's sampling params
+    sampling: Optional[SamplingParams] = None
+    # reuse the cached conditioning prefix of this voice, if the scheduler has a `VoicePrefixCache`
+    voice_id: Optional[Hashable] = None
+
+    # filled in by the scheduler
+    request_id: Optional[int] = None
+    speech_tokens: Optional[Tensor] = None
+    submitted_at: Optional[float] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # decode steps saved by the alignment analyzer forcing an EOS
+    tokens_saved: int = 0
+
+    @property
+    def num_rows(self):
+        "Number of batch rows this request occupies (2 with CFG)."
+        return 2 if self.cfg_weight > 0 else 1
+
+    @property
+    def kv_cost(self):
+        "Worst-case number of KV cache slots this request holds (not counting the conditioning prefix)."
+        return self.num_rows * (self.text_tokens.size(-1) + self.max_new_tokens)
+
+
+class T3Scheduler:
+    """
+    Iteration-level ("continuous") batching for T3 speech-token generation.
+
+    Queued requests are admitted into the running decode batch between steps, and requests leave the batch (freeing
+    their KV cache rows) on the step they emit EOS. Short requests therefore never wait on the longest utterance of
+    a static batch, and decode steps aren't spent on rows that have already finished.
+
+    With `prefill_chunk_size`, admitted requests are prefilled one chunk per step, each followed by a decode step of
+    the running batch, so a long prompt doesn't stall the requests already decoding.
+
+    Usage:
+        scheduler = T3Scheduler(t3, max_batch_rows=16)
+        scheduler.submit(T3Request(t3_cond=cond, text_tokens=tokens))
+        while scheduler.has_work():
+            for request in scheduler.step():
+                ...  # request.speech_tokens
+    """
+
+    def __init__(
+        self,
+        t3,
+        *,
+        max_batch_rows=16,
+        temperature=0.8,
+        min_p=0.05,
+        top_p=1.00,
+        repetition_penalty=1.2,
+        cache_implementation="static",
+        latency_window=100,
+        prefix_cache: Optional[VoicePrefixCache]=None,
+        alignment_analysis=False,
+        budget_estimator: Optional[TokenBudgetEstimator]=None,
+        max_kv_tokens: Optional[int]=None,
+        cfg_schedule: Optional[CFGSchedule]=None,
+        prefill_chunk_size: Optional[int]=None,
+        kv_pool: Optional[KVBlockPool]=None,
+    ):
+        """
+        `alignment_analysis` runs an `AlignmentStreamAnalyzer` per request to stop runaway generations early; call
+        `close()` when done with the scheduler to remove its attention spy.
+
+        Requests without `max_new_tokens` get the `budget_estimator` estimate for their text (by default, one
+        without punctuation info), and with `max_kv_tokens` requests are only admitted while the sum of their
+        `kv_cost` fits.
+
+        `cfg_schedule` limits when the uncond rows of CFG requests run, see `CFGSchedule`.
+
+        `prefill_chunk_size` splits the prefill of admitted requests into chunks of that many prompt tokens.
+
+        With a `kv_pool`, the KV cache is paged (see `PagedKVCache`, `cache_implementation` is ignored): requests
+        take blocks as they grow instead of reserving their whole budget, and are admitted while the pool has blocks
+        for their prompt, on top of one free block per active row. An exhausted pool raises a `RuntimeError`, so
+        size it for the expected load, or set `max_kv_tokens` to reserve worst-case budgets as well.
+        """
+        assert cache_implementation in ("static", "dynamic"), cache_implementation
+        self.t3 = t3
+        self.max_batch_rows = max_batch_rows
+        self.cache_implementation = cache_implementation
+        self.prefix_cache = prefix_cache
+        self.budget_estimator = budget_estimator or TokenBudgetEstimator(max_tokens=t3.hp.max_speech_tokens)
+        self.max_kv_tokens = max_kv_tokens
+        self.cfg_schedule = cfg_schedule
+        self.prefill_chunk_size = prefill_chunk_size
+        self.kv_pool = kv_pool
+        self.default_sampling = SamplingParams(
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+        )
+
+        self.queue = deque()
+        self.active: Dict[int, T3Request] = {}
+        self.batch: Optional[T3DecodeBatch] = None
+        self.logits: Optional[Tensor] = None  # (N, V) pending logits of the running batch
+        self.pending: Optional[T3PendingPrefill] = None  # admitted requests whose prefill is in progress
+        self.step_latencies = deque(maxlen=latency_window)
+        self._request_ids = itertools.count()
+        self.analyzer = None
+        if alignment_analysis:
+            self.analyzer = BatchAlignmentAnalyzer(t3.tfmr, eos_idx=t3.hp.stop_speech_token)
+
+    # ---- metrics ----
+
+    @property
+    def queue_depth(self):
+        "Number of requests waiting to be admitted."
+        return len(self.queue)
+
+    @property
+    def active_requests(self):
+        return 0 if self.batch is None else self.batch.num_requests
+
+    @property
+    def active_rows(self):
+        "Number of backbone rows in the running batch (cond + uncond)."
+        return 0 if self.batch is None else self.batch.num_rows
+
+    @property
+    def prefilling_rows(self):
+        "Number of backbone rows of the requests being prefilled."
+        return 0 if self.pending is None else self.pending.num_rows
+
+    @property
+    def kv_tokens_reserved(self):
+        "Sum of the `kv_cost` of the active requests."
+        return sum(r.kv_cost for r in self.active.values())
+
+    @property
+    def last_step_latency(self):
+        "Wall-clock seconds of the most recent `step()`."
+        return self.step_latencies[-1] if self.step_latencies else None
+
+    @property
+    def mean_step_latency(self):
+        "Mean wall-clock seconds per `step()` over the last `latency_window` steps."
+        return sum(self.step_latencies) / len(self.step_latencies) if self.step_latencies else None
+
+    # ---- scheduling ----
+
+    def submit(self, request: T3Request) -> int:
+        "Queues `request` for admission on the next step, returns its request id."
+        request.request_id = next(self._request_ids)
+        if request.max_new_tokens is None:
+            request.max_new_tokens = self.budget_estimator.estimate_tokens(request.text_tokens)
+        if request.sampling is None:
+            request.sampling = self.default_sampling
+        request.submitted_at = time.perf_counter()
+        self.queue.append(request)
+        return request.request_id
+
+    def has_work(self):
+        return len(self.queue) > 0 or self.batch is not None or self.pending is not None
+
+    def _admit(self):
+        """
+        Starts prefilling as many queued requests as fit in the free rows, and advances the prefill in progress by
+        one chunk. Requests are merged into the running batch once their prefill is done.
+        """
+        if self.pending is None:
+            self._start_prefill()
+        if self.pending is None:
+            return
+
+        new_logits = self.t3.prefill_step(self.pending)
+        if new_logits is None:
+            return
+        new_batch, self.pending = self.pending.batch, None
+        if self.analyzer is not None:
+            new_logits = self.analyzer.step(new_batch, new_logits)
+        if self.batch is None:
+            self.batch, self.logits = new_batch, new_logits
+        else:
+            self.t3.flush_uncond(self.batch)
+            self.batch = T3DecodeBatch.concatenate([self.batch, new_batch])
+            self.logits = torch.cat([self.logits, new_logits])
+
+    def _start_prefill(self):
+        "Pops as many queued requests as fit in the free rows / KV budget, and sets up their prefill."
+        admitted = []
+        free_rows = self.max_batch_rows - self.active_rows
+        free_kv = float("inf") if self.max_kv_tokens is None else self.max_kv_tokens - self.kv_tokens_reserved
+
+        free_blocks = float("inf")
+        if self.kv_pool is not None:
+            # (prefix blocks no active row uses are evicted on demand)
+            free_blocks = self.kv_pool.num_free_blocks + self.kv_pool.num_evictable_blocks - self.active_rows
+
+        def prompt_blocks(request):
+            "Pool blocks for the text and BOS of every row, plus a block to grow in (the voice prefix is shared)."
+            if self.kv_pool is None:
+                return 0
+            return request.num_rows * (self.kv_pool.blocks_for(request.text_tokens.size(-1) + 2) + 1)
+
+        def fits(request):
+            return (
+                request.num_rows <= free_rows
+                and request.kv_cost <= free_kv
+                and prompt_blocks(request) <= free_blocks
+            )
+
+        while self.queue and (fits(self.queue[0]) or (self.batch is None and not admitted)):
+            request = self.queue.popleft()
+            free_rows -= request.num_rows
+            free_kv -= request.kv_cost
+            free_blocks -= prompt_blocks(request)
+            admitted.append(request)
+        if not admitted:
+            return
+
+        now = time.perf_counter()
+        for request in admitted:
+            request.started_at = now
+            self.active[request.request_id] = request
+            if self.analyzer is not None:
+                self.analyzer.add(request.request_id, request.text_tokens.size(-1), num_bos=request.num_rows)
+
+        self.pending = self.t3.start_prefill(
+            t3_conds=[r.t3_cond for r in admitted],
+            text_tokens=[r.text_tokens for r in admitted],
+            cfg_weights=[float(r.cfg_weight) for r in admitted],
+            request_ids=[r.request_id for r in admitted],
+            sampling_params=[r.sampling for r in admitted],
+            max_new_tokens=(
+                max(r.max_new_tokens for r in admitted) if self.cache_implementation == "static" else None
+            ),
+            prefix_cache=self.prefix_cache,
+            voice_ids=[r.voice_id for r in admitted],
+            cfg_schedule=self.cfg_schedule,
+            chunk_size=self.prefill_chunk_size,
+            kv_pool=self.kv_pool,
+        )
+
+    @torch.inference_mode()
+    def step(self) -> List[T3Request]:
+        """
+        Admits queued requests, samples one token for every active request and advances the batch.
+
+        Returns: the requests that finished on this step, with `speech_tokens` filled in.
+        """
+        t0 = time.perf_counter()
+        self._admit()
+        if self.batch is None:
+            return []
+
+        batch = self.batch
+        next_tokens = batch.sampler(self.logits)
+        batch.append_tokens(next_tokens)
+
+        # Finished requests leave the batch immediately
+        is_eos = (next_tokens.view(-1) == self.t3.hp.stop_speech_token).tolist()
+        finished, keep = [], []
+        now = time.perf_counter()
+        for req_idx, eos in enumerate(is_eos):
+            request = self.active[batch.request_ids[req_idx]]
+            if eos or batch.num_generated[req_idx] >= request.max_new_tokens:
+                request.speech_tokens = batch.get_generated(req_idx)
+                request.finished_at = now
+                if self.analyzer is not None:
+                    request.tokens_saved = self.analyzer.finish(
+                        request.request_id, batch.num_generated[req_idx], request.max_new_tokens,
+                    )
+                finished.append(request)
+                del self.active[request.request_id]
+            else:
+                keep.append(req_idx)
+
+        if len(keep) == 0:
+            batch.release()
+            self.batch, self.logits = None, None
+        else:
+            if len(keep) < batch.num_requests:
+                batch.filter(keep)
+                batch.compact([self.active[request_id].max_new_tokens for request_id in batch.request_ids])
+                next_tokens = next_tokens[keep]
+            self.logits = self.t3.decode_step(batch, next_tokens)
+            if self.analyzer is not None:
+                self.logits = self.analyzer.step(batch, self.logits)
+
+        self.step_latencies.append(time.perf_counter() - t0)
+        return finished
+
+    def close(self):
+        if self.analyzer is not None:
+            self.analyzer.close()
+
+    def run(self) -> Dict[int, Tensor]:
+        "Steps until all submitted requests are done, returns their speech tokens by request id."
+        results = {}
+        while self.has_work():
+            for request in self.step():
+                results[request.request_id] = request.speech_tokens
+        return results
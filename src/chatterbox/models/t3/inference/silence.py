@@ -0,0 +1,97 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+import logging
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import FrozenSet, Optional
+
+import torch
+from torch import Tensor
+
+from ...s3tokenizer import S3_SR
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SilenceDetector:
+    """
+    Spots runs of near-silence speech tokens, so T3 can stop on trailing dead air instead of decoding it (and
+    vocoding it) up to `stop_speech_token`.
+
+    - `min_run`: silence tokens after which a request is stopped once its alignment is complete (needs alignment
+      analysis)
+    - `max_run`: opt-in safety cap, silence tokens after which a request is stopped regardless. Off by default:
+      long pauses can be legitimate, so without alignment analysis the silence is only trimmed
+    - `keep_tokens`: trailing silence tokens left in place by `trim`, for a natural decay
+
+    `silence_tokens` come from `calibrate`, which runs the S3 tokenizer on silence and low-level noise.
+    """
+    silence_tokens: FrozenSet[int] = field(default_factory=frozenset)
+    min_run: int = 10  # 400ms
+    max_run: Optional[int] = None
+    keep_tokens: int = 2
+
+    @classmethod
+    @torch.inference_mode()
+    def calibrate(
+        cls,
+        tokenizer,
+        seconds=2.0,
+        noise_levels=(0.0, 1e-4, 1e-3, 3e-3),
+        min_share=0.02,
+        seed=0,
+        **kwargs,
+    ):
+        """
+        Finds the tokens the `S3Tokenizer` assigns to silence, by tokenizing `seconds` of digital silence and of
+        gaussian noise at each of `noise_levels` (amplitudes at 16kHz). Tokens making up less than `min_share` of the
+        result are left out.
+        """
+        generator = torch.Generator().manual_seed(seed)
+        num_samples = int(seconds * S3_SR)
+        wavs = [level * torch.randn(num_samples, generator=generator) for level in noise_levels]
+        counts = Counter()
+        for wav in wavs:
+            tokens, _ = tokenizer.forward([wav.numpy()])
+            counts.update(tokens.view(-1).tolist())
+        total = sum(counts.values())
+        silence_tokens = frozenset(t for t, n in counts.items() if n >= min_share * total)
+        logger.info(f"calibrated {len(silence_tokens)} silence tokens: {sorted(silence_tokens)}")
+        return cls(silence_tokens=silence_tokens, **kwargs)
+
+    def lookup_table(self, vocab_size: int, device=None) -> Tensor:
+        "(vocab_size,) bool tensor, True for the silence tokens."
+        table = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+        table[[t for t in self.silence_tokens if t < vocab_size]] = True
+        return table
+
+    def should_stop(self, silence_runs: Tensor, aligned: Tensor) -> Tensor:
+        """
+        Args:
+            silence_runs: (N,) number of trailing silence tokens of each request
+            aligned: (N,) bool, whether the alignment of each request reached the end of its text
+        Returns: (N,) bool, the requests to stop
+        """
+        stop = aligned & (silence_runs >= self.min_run)
+        if self.max_run is not None:
+            stop |= silence_runs >= self.max_run
+        return stop
+
+    def force_eos(self, logits: Tensor, silence_runs: Tensor, aligned: Tensor, eos_idx: int) -> Tensor:
+        "Makes the requests of `logits` (N, V) that `should_stop` emit EOS next, without a host sync."
+        stop = self.should_stop(silence_runs, aligned)
+        # (±2**15 is safe for all dtypes >= 16bit, see `AlignmentStreamAnalyzer`)
+        eos_logits = torch.full_like(logits[:1], -2**15)
+        eos_logits[:, eos_idx] = 2**15
+        return torch.where(stop[:, None], eos_logits, logits)
+
+    def trim(self, speech_tokens: Tensor) -> Tensor:
+        "Drops the trailing silence of 1D (EOS-free) speech tokens, but for `keep_tokens`."
+        if not self.silence_tokens:
+            return speech_tokens
+        silence_tokens = torch.tensor(sorted(self.silence_tokens), device=speech_tokens.device)
+        speech = (~torch.isin(speech_tokens, silence_tokens)).nonzero()
+        n = int(speech[-1]) + 1 if len(speech) > 0 else 0
+        return speech_tokens[:n + self.keep_tokens]
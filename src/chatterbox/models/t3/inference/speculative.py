@@ -0,0 +1,39 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+from dataclasses import dataclass
+
+
+@dataclass
+class SpeculativeConfig:
+    """
+    Self-speculative decoding settings for `T3.inference_speculative`: the first `draft_layers` backbone layers
+    (plus the final norm and `speech_head`) draft `num_draft_tokens` tokens, which the full-depth model verifies in
+    one pass.
+    """
+    draft_layers: int = 8
+    num_draft_tokens: int = 4
+
+
+@dataclass
+class SpeculativeStats:
+    "Acceptance metrics of a speculative generation, to tune `SpeculativeConfig`."
+    rounds: int = 0
+    drafted: int = 0
+    accepted: int = 0
+    generated: int = 0
+
+    @property
+    def acceptance_rate(self):
+        "Fraction of drafted tokens that were accepted."
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    @property
+    def tokens_per_round(self):
+        "Tokens generated per full-depth verification pass (1 for regular decoding)."
+        return self.generated / self.rounds if self.rounds else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.rounds} rounds, {self.accepted}/{self.drafted} drafted tokens accepted "
+            f"({self.acceptance_rate:.1%}), {self.tokens_per_round:.2f} tokens per round"
+        )
@@ -74,39 +74,53 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         self,
         inputs_embeds: torch.Tensor,
         past_key_values: Optional[torch.Tensor]=None,
+        attention_mask: Optional[torch.Tensor]=None,
+        position_ids: Optional[torch.LongTensor]=None,
+        cache_position: Optional[torch.LongTensor]=None,
         use_cache=True,
         output_attentions=False,
-        output_hidden_states=True,
+        output_hidden_states=False,
         return_dict=True,
+        num_logits_to_keep: int=0,
     ):
         """
         This is a method used by huggingface's generate() method.
         Overridden here to apply our custom layer norm and speech logit projection layers.
 
-        :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. If past key values are given,
-        S should be 1.
+        NOTE: `output_attentions` / `output_hidden_states` are only needed for analysis. `output_attentions=True`
+        moves every layer off the SDPA kernel onto eager attention, use `AlignmentStreamAnalyzer` to capture a single
+        layer instead.
+
+        :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. With past key values, S is 1 when
+        decoding, or the rest of the prompt after a cached voice prefix.
+        :param attention_mask: (B, past + S) padding mask for left-padded batches, 1 for real tokens.
+        :param position_ids: (B, S) per-row positions, required along with `attention_mask` for left-padded rows.
+        :param cache_position: (S,) cache slots to write the new keys / values to, required for static caches.
+        :param num_logits_to_keep: only project the last `num_logits_to_keep` positions to logits, 0 for all.
         """
         is_large_input = inputs_embeds.size(1) != 1
-        has_cache = past_key_values is not None and len(past_key_values) > 0
-        assert not (is_large_input and has_cache)
+        has_cache = past_key_values is not None and past_key_values.get_seq_length() > 0
+        assert not (is_large_input and has_cache) or cache_position is not None
         assert return_dict
-        assert output_hidden_states
 
         tfmr_out = self.model(
             inputs_embeds=inputs_embeds,
             past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            cache_position=cache_position,
             use_cache=use_cache,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=True,
         )
-        hidden_states = tfmr_out.hidden_states[-1]  # (B, seq, dim)
+        hidden_states = tfmr_out.last_hidden_state  # (B, seq, dim), after the final norm
 
-        logits = self.speech_head(hidden_states)
+        logits = self.speech_head(hidden_states[:, -num_logits_to_keep:])
         # assert inputs_embeds.size(0) == 1 # (disabled for CFG)
 
-        # NOTE: hallucination handler may modify logits to force emit an EOS token
-        # logits = self.alignment_stream_analyzer.step(logits)
+        # NOTE: the hallucination handler (which may modify logits to force emit an EOS token) runs on the
+        # CFG-combined logits in the decode loops, see `BatchAlignmentAnalyzer`
 
         return CausalLMOutputWithCrossAttentions(
             logits=logits,
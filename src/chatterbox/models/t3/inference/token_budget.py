@@ -0,0 +1,56 @@
+# Copyright (c) 2025 Resemble AI
+# MIT License
+import math
+from dataclasses import dataclass, field
+from typing import FrozenSet
+
+import torch
+from torch import Tensor
+
+from ...s3tokenizer import S3_TOKEN_RATE
+
+
+PAUSE_CHARS = (".", "!", "?", ",", ";", ":", "-")
+
+
+@dataclass
+class TokenBudgetEstimator:
+    """
+    Predicts an upper bound on the number of speech tokens T3 needs for a text, from its text token count and the
+    number of punctuation pauses in it, at `S3_TOKEN_RATE` speech tokens per second.
+
+    The defaults are deliberately loose (about twice the duration of normal-paced speech) so that a budget only
+    cuts off hallucinated tails, never real speech. Used to cap generation per request, and to size the KV cache.
+    """
+    # worst-case seconds of speech per text token
+    seconds_per_text_token: float = 0.25
+    # worst-case extra seconds for every punctuation pause
+    seconds_per_pause: float = 0.5
+    # leading / trailing silence
+    base_seconds: float = 1.0
+    min_tokens: int = 50
+    max_tokens: int = 4096
+    # text token ids counted as pauses (see `from_tokenizer`)
+    pause_token_ids: FrozenSet[int] = field(default_factory=frozenset)
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, **kwargs):
+        "Looks up the punctuation token ids in the vocab of an `EnTokenizer`."
+        vocab = tokenizer.tokenizer.get_vocab()
+        pause_token_ids = frozenset(vocab[c] for c in PAUSE_CHARS if c in vocab)
+        return cls(pause_token_ids=pause_token_ids, **kwargs)
+
+    def estimate(self, num_text_tokens: int, num_pauses: int = 0) -> int:
+        "Upper bound on speech tokens (EOS included) for a text of `num_text_tokens` with `num_pauses` pauses."
+        seconds = self.base_seconds + num_text_tokens * self.seconds_per_text_token + num_pauses * self.seconds_per_pause
+        num_tokens = math.ceil(seconds * S3_TOKEN_RATE)
+        return max(self.min_tokens, min(self.max_tokens, num_tokens))
+
+    def estimate_tokens(self, text_tokens: Tensor) -> int:
+        "Same as `estimate`, from the 1D text tokens of a request (start / stop tokens are counted too)."
+        text_tokens = torch.atleast_2d(text_tokens)[0]
+        num_pauses = 0
+        if self.pause_token_ids:
+            pause_token_ids = torch.tensor(sorted(self.pause_token_ids), device=text_tokens.device)
+            num_pauses = int(torch.isin(text_tokens, pause_token_ids).sum())
+        return self.estimate(text_tokens.numel(), num_pauses)
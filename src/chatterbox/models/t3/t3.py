@@ -1,14 +1,15 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
 import logging
-from typing import Union, Optional, List
+from typing import Union, Optional, List, Iterator, Callable
 
 from tqdm import tqdm
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
+from torch.nn.utils.rnn import pad_sequence
 from transformers import LlamaModel, LlamaConfig
-from transformers.generation.logits_process import MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
+from transformers.cache_utils import DynamicCache
 
 from .modules.learned_pos_emb import LearnedPositionEmbeddings
 
@@ -16,6 +17,16 @@ from .modules.cond_enc import T3CondEnc, T3Cond
 from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
+from .inference.decode_batch import T3DecodeBatch, T3PendingPrefill, pad_left
+from .inference.kv_cache import T3StaticCache, cache_row_view, pad_cache_tensor
+from .inference.paged_kv_cache import KVBlockPool, PagedKVCache
+from .inference.sampler import SamplingParams, T3Sampler
+from .inference.cfg_schedule import CFGSchedule, CFGState
+from .inference.speculative import SpeculativeConfig, SpeculativeStats
+from .inference.prefix_cache import VoicePrefix, VoicePrefixCache
+from .inference.alignment_stream_analyzer import AttentionSpy, BatchAlignmentAnalyzer
+from .inference.candidate_selection import CandidateScore, select_candidate
+from .inference.silence import SilenceDetector
 from ..utils import AttrDict
 
 
@@ -63,6 +74,9 @@ class T3(nn.Module):
         self.text_head = nn.Linear(self.cfg.hidden_size, hp.text_tokens_dict_size, bias=False)
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=False)
         self.compiled = False
+        self.speculative_stats: Optional[SpeculativeStats] = None
+        # per request, the scores of the candidates of the last best-of-N generation
+        self.candidate_scores: Optional[List[List[CandidateScore]]] = None
 
     @property
     def device(self):
@@ -200,6 +214,375 @@ class T3(nn.Module):
 
         return loss_text, loss_speech
 
+    def prepare_prompt_embeds(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        speech_tokens: Optional[Tensor]=None,
+        cfg: bool=False,
+    ):
+        """
+        Prefill embeddings for a single request: `[cond, text, BOS]`, plus an unconditional row with the text
+        embeddings zeroed when `cfg` is set.
+
+        Returns: (1, len, dim), or (2, len, dim) with CFG
+        """
+        suffix = self.prepare_prompt_suffix_embeds(text_tokens=text_tokens, speech_tokens=speech_tokens, cfg=cfg)
+        cond_emb = self.prepare_conditioning(t3_cond)[:1]  # (1, len_cond, dim)
+        return torch.cat([cond_emb.expand(suffix.size(0), -1, -1), suffix], dim=1)
+
+    def prepare_prompt_suffix_embeds(
+        self,
+        *,
+        text_tokens: Tensor,
+        speech_tokens: Optional[Tensor]=None,
+        cfg: bool=False,
+    ):
+        """
+        The part of `prepare_prompt_embeds` that follows the conditioning: `[text, BOS]`.
+
+        Returns: (1, len, dim), or (2, len, dim) with CFG
+        """
+        text_tokens = torch.atleast_2d(text_tokens)[:1].to(dtype=torch.long, device=self.device)
+        if speech_tokens is None:
+            speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
+        speech_tokens = torch.atleast_2d(speech_tokens)[:1].to(dtype=torch.long, device=self.device)
+
+        if cfg:
+            text_tokens = text_tokens.expand(2, -1)
+            speech_tokens = speech_tokens.expand(2, -1)
+
+        text_emb = self.text_emb(text_tokens)  # (B, len_text, dim)
+        if cfg:
+            text_emb[1].zero_()  # CFG uncond
+
+        speech_emb = self.speech_emb(speech_tokens)  # (B, len_speech, dim)
+        if self.hp.input_pos_emb == "learned":
+            text_emb = text_emb + self.text_pos_emb(text_tokens)
+            speech_emb = speech_emb + self.speech_pos_emb(speech_tokens)
+        embeds = torch.cat([text_emb, speech_emb], dim=1)
+
+        # NOTE: CFG decoding has always fed a second BOS token after the prompt
+        if cfg:
+            bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=self.device)
+            bos_embed = self.speech_emb(bos_token) + self.speech_pos_emb.get_fixed_embedding(0)
+            embeds = torch.cat([embeds, bos_embed.expand(2, -1, -1)], dim=1)
+
+        return embeds
+
+    @torch.inference_mode()
+    def compute_prefix_kv(self, t3_cond: T3Cond) -> VoicePrefix:
+        """
+        Runs only the conditioning prefix of `t3_cond` through the backbone, for reuse across requests with the
+        same voice (see `VoicePrefixCache`). The prefix always sits at RoPE positions `[0, len_cond)`.
+        """
+        cond_emb = self.prepare_conditioning(t3_cond)[:1]  # (1, len_cond, dim)
+        past = DynamicCache()
+        self.tfmr(inputs_embeds=cond_emb, past_key_values=past, use_cache=True, return_dict=True)
+        return VoicePrefix(keys=list(past.key_cache), values=list(past.value_cache))
+
+    def get_prefix(self, prefix_cache: VoicePrefixCache, voice_id, t3_cond: T3Cond) -> VoicePrefix:
+        "Looks up the prefix KV of `voice_id` (at the exaggeration of `t3_cond`), computing it on a miss."
+        key = self._prefix_key(prefix_cache, voice_id, t3_cond)
+        return prefix_cache.get_or_compute(key, lambda: self.compute_prefix_kv(t3_cond))
+
+    @staticmethod
+    def _prefix_key(prefix_cache: VoicePrefixCache, voice_id, t3_cond: T3Cond):
+        return prefix_cache.make_key(voice_id, torch.as_tensor(t3_cond.emotion_adv).view(-1)[0])
+
+    def _get_patched_model(self):
+        # TODO? synchronize the expensive compile function
+        # with self.compile_lock:
+        if not self.compiled:
+            self.patched_model = T3HuggingfaceBackend(
+                config=self.cfg,
+                llama=self.tfmr,
+                speech_enc=self.speech_emb,
+                speech_head=self.speech_head,
+                alignment_stream_analyzer=None,
+            )
+            self.compiled = True
+        return self.patched_model
+
+    def prefill_batch(self, **kwargs):
+        """
+        Runs the prompts of several independent requests through the backbone as one left-padded batch, see
+        `start_prefill` for the arguments.
+
+        Returns: the `T3DecodeBatch` holding the KV cache, and the per-request logits (N, V) for the first token.
+        """
+        pending = self.start_prefill(**kwargs)
+        logits = None
+        while logits is None:
+            logits = self.prefill_step(pending)
+        return pending.batch, logits
+
+    def start_prefill(
+        self,
+        *,
+        t3_conds: List[T3Cond],
+        text_tokens: List[Tensor],
+        cfg_weights: List[float],
+        request_ids: Optional[List[int]]=None,
+        sampling_params: Optional[List[SamplingParams]]=None,
+        max_new_tokens: Optional[int]=None,
+        prefix_cache: Optional[VoicePrefixCache]=None,
+        voice_ids: Optional[List]=None,
+        cfg_schedule: Optional[CFGSchedule]=None,
+        chunk_size: Optional[int]=None,
+        kv_pool: Optional[KVBlockPool]=None,
+    ) -> T3PendingPrefill:
+        """
+        Sets up the prefill of several independent requests as one left-padded batch, to be run by `prefill_step`.
+
+        If `max_new_tokens` is given, the KV cache is a `T3StaticCache` pre-sized for the prompt plus that many
+        tokens, otherwise it is a `DynamicCache` that grows on every step. With a `kv_pool`, it is a `PagedKVCache`
+        taking blocks from the pool as it grows (`max_new_tokens` then only sizes the output buffer), and rows
+        share the pool blocks of their voice prefix rather than copying it.
+
+        `sampling_params` holds one `SamplingParams` per request (defaults if not given).
+
+        With a `prefix_cache`, requests with a `voice_ids` entry (None to opt out) reuse the KV of their
+        conditioning prefix, and only `[text, BOS]` goes through the backbone. Rows are then laid out as
+        `[prefix | padding | text, BOS]`, with the padding masked out and RoPE positions continuing the prefix.
+
+        `cfg_schedule` limits when the uncond rows run during decoding, see `CFGSchedule`.
+
+        With a `chunk_size`, the prompt goes through the backbone `chunk_size` tokens at a time (one chunk per
+        `prefill_step`), which bounds the activation memory of long prompts and lets a scheduler interleave the
+        chunks with decode steps of a running batch.
+        """
+        assert chunk_size is None or chunk_size >= 2, "the last chunk must hold the BOS tokens"
+        assert len(t3_conds) == len(text_tokens) == len(cfg_weights)
+        N = len(t3_conds)
+        cfgs = [w > 0 for w in cfg_weights]
+        # cond rows first, then the uncond rows of the CFG requests
+        row_requests = list(range(N)) + [i for i in range(N) if cfgs[i]]
+
+        if prefix_cache is None:
+            prompts = [
+                self.prepare_prompt_embeds(t3_cond=c, text_tokens=t, cfg=cfg)
+                for c, t, cfg in zip(t3_conds, text_tokens, cfgs)
+            ]
+            prefixes = None
+        else:
+            voice_ids = voice_ids or [None] * N
+            prefixes = [
+                self.compute_prefix_kv(c) if v is None else self.get_prefix(prefix_cache, v, c)
+                for c, v in zip(t3_conds, voice_ids)
+            ]
+            prompts = [
+                self.prepare_prompt_suffix_embeds(text_tokens=t, cfg=cfg)
+                for t, cfg in zip(text_tokens, cfgs)
+            ]
+
+        rows = [p[0] for p in prompts] + [p[1] for p in prompts if p.size(0) > 1]
+        inputs_embeds, attention_mask = pad_left(rows)
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        prefix_len = 0
+        if prefixes is not None:
+            row_prefix_lens = [prefixes[req].length for req in row_requests]
+            prefix_len = max(row_prefix_lens)
+            prefix_mask = torch.zeros(len(rows), prefix_len, dtype=torch.long, device=self.device)
+            for row, length in enumerate(row_prefix_lens):
+                prefix_mask[row, prefix_len - length:] = 1
+            attention_mask = torch.cat([prefix_mask, attention_mask], dim=1)
+            position_ids = position_ids + torch.tensor(row_prefix_lens, device=self.device)[:, None]
+        prompt_len = prefix_len + inputs_embeds.size(1)
+
+        if kv_pool is not None:
+            past = PagedKVCache(kv_pool, len(rows))
+        elif max_new_tokens is None:
+            past = DynamicCache()
+        else:
+            capacity = prompt_len + max_new_tokens
+            past = T3StaticCache(self.cfg, len(rows), capacity, device=self.device, dtype=inputs_embeds.dtype)
+            attention_mask = F.pad(attention_mask, (0, max_new_tokens), value=1)
+
+        if prefixes is not None and kv_pool is not None:
+            prefix_keys = [
+                None if v is None else self._prefix_key(prefix_cache, v, c) for c, v in zip(t3_conds, voice_ids)
+            ]
+            past.share_prefixes(
+                [prefixes[req] for req in row_requests], prefix_len, [prefix_keys[req] for req in row_requests],
+            )
+        elif prefixes is not None:
+            # copy the (left-padded) prefixes into the cache, shared by the cond and uncond rows of a request
+            cache_kwargs = {"cache_position": torch.arange(prefix_len, device=self.device)}
+            for layer_idx in range(self.cfg.num_hidden_layers):
+                keys, values = [], []
+                for req in row_requests:
+                    prefix = prefixes[req]
+                    keys.append(pad_cache_tensor(prefix.keys[layer_idx], prefix_len - prefix.length, 0))
+                    values.append(pad_cache_tensor(prefix.values[layer_idx], prefix_len - prefix.length, 0))
+                past.update(torch.cat(keys), torch.cat(values), layer_idx, cache_kwargs)
+
+        batch = T3DecodeBatch(
+            past=past,
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, -1] + 1,
+            row_requests=row_requests,
+            cfg_weights=torch.tensor(cfg_weights, dtype=torch.float, device=self.device),
+            speech_positions=torch.ones(N, dtype=torch.long, device=self.device),
+            output_ids=torch.zeros(N, max_new_tokens or 256, dtype=torch.long, device=self.device),
+            output_len=0,
+            num_generated=[0] * N,
+            sampler=T3Sampler.create(
+                sampling_params or [SamplingParams()] * N,
+                start_token=self.hp.start_speech_token,
+                stop_token=self.hp.stop_speech_token,
+                device=self.device,
+            ),
+            request_ids=list(range(N)) if request_ids is None else list(request_ids),
+            cfg_state=None if cfg_schedule is None else CFGState.create(cfg_schedule, N, device=self.device),
+        )
+        return T3PendingPrefill(
+            batch=batch,
+            inputs_embeds=inputs_embeds,
+            position_ids=position_ids,
+            prefix_len=prefix_len,
+            chunks=T3PendingPrefill.split(inputs_embeds.size(1), chunk_size),
+        )
+
+    def prefill_step(self, pending: T3PendingPrefill) -> Optional[Tensor]:
+        """
+        Feeds the next chunk of a `start_prefill` prompt through the backbone.
+
+        Returns: the per-request logits (N, V) for the first token once the last chunk is done, None before that.
+        """
+        assert not pending.done
+        start, end = pending.chunks[pending.next_chunk]
+        batch = pending.batch
+        attention_mask = batch.attention_mask
+        if not batch.is_static:
+            attention_mask = attention_mask[:, :pending.prefix_len + end]  # the slots filled after this chunk
+        output = self._get_patched_model()(
+            inputs_embeds=pending.inputs_embeds[:, start:end],
+            past_key_values=batch.past,
+            attention_mask=attention_mask,
+            position_ids=pending.position_ids[:, start:end],
+            cache_position=torch.arange(pending.prefix_len + start, pending.prefix_len + end, device=self.device),
+            use_cache=True,
+            return_dict=True,
+            num_logits_to_keep=1,
+        )
+        batch.past = output.past_key_values
+        pending.next_chunk += 1
+        if not pending.done:
+            return None
+        # the prompt embeddings are no longer needed
+        pending.inputs_embeds = pending.position_ids = None
+        return batch.apply_cfg(output.logits[:, -1, :])
+
+    def decode_step(self, batch: T3DecodeBatch, next_tokens: Tensor):
+        """
+        Feeds the sampled tokens (N, 1) of every request in `batch` through the backbone, advancing its KV cache.
+
+        Returns: the per-request logits (N, V) for the following token.
+        """
+        next_token_embed = self.speech_emb(next_tokens)
+        next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(batch.speech_positions[:, None])
+
+        N = batch.num_requests
+        seq_len = batch.seq_len
+        cfg_state = batch.cfg_state
+        use_interval = cfg_state is not None and cfg_state.uses_interval and batch.num_rows > N
+        if not use_interval:
+            inputs_embeds = batch.expand_to_rows(next_token_embed)  # cond + uncond rows
+            if not batch.is_static:
+                batch.attention_mask = F.pad(batch.attention_mask, (0, 1), value=1)
+            output = self._get_patched_model()(
+                inputs_embeds=inputs_embeds,
+                past_key_values=batch.past,
+                attention_mask=batch.attention_mask,
+                position_ids=batch.position_ids[:, None],
+                cache_position=torch.arange(seq_len, seq_len + 1, device=self.device),
+                return_dict=True,
+                num_logits_to_keep=1,
+            )
+            batch.past = output.past_key_values
+            guided = True
+        else:
+            # cond rows only, the uncond rows catch up on guided steps
+            assert batch.is_static, "CFG intervals need a static KV cache"
+            output = self._get_patched_model()(
+                inputs_embeds=next_token_embed,
+                past_key_values=cache_row_view(batch.past, slice(0, N)),
+                attention_mask=batch.attention_mask[:N],
+                position_ids=batch.position_ids[:N, None],
+                cache_position=torch.arange(seq_len, seq_len + 1, device=self.device),
+                return_dict=True,
+                num_logits_to_keep=1,
+            )
+            batch.past.set_seq_length(seq_len + 1)
+            guided = cfg_state.is_guided_step()
+        batch.position_ids = batch.position_ids + 1
+        batch.speech_positions = batch.speech_positions + 1
+
+        row_logits = output.logits[:, -1, :]
+        logits_cond = row_logits[:N]
+        if not use_interval:
+            logits = batch.apply_cfg(row_logits)
+        elif guided:
+            logits_uncond = self._advance_uncond(batch, cfg_state.uncond_lag + 1)
+            cfg_state.uncond_lag = 0
+            logits = batch.apply_cfg(torch.cat([logits_cond, logits_uncond]))
+        else:
+            cfg_state.uncond_lag += 1
+            logits = batch.apply_cached_cfg(logits_cond)
+
+        if cfg_state is not None and batch.num_rows > N:
+            tv_distance = None
+            if guided and cfg_state.schedule.convergence_threshold is not None:
+                p_cond = logits_cond.float().softmax(dim=-1)
+                p_uncond = (logits_cond - cfg_state.delta).float().softmax(dim=-1)
+                tv_distance = 0.5 * (p_cond - p_uncond).abs().sum(dim=-1)
+            drop = cfg_state.requests_to_drop(batch.num_generated, batch.has_uncond, tv_distance)
+            if drop:
+                batch.drop_uncond(drop)
+                if batch.num_rows == N:
+                    cfg_state.uncond_lag = 0
+        return logits
+
+    def _advance_uncond(self, batch: T3DecodeBatch, num_tokens: int):
+        """
+        Feeds the last `num_tokens` sampled tokens to the uncond rows of `batch`, which are that far behind the cond
+        rows in its static cache. The tokens go to the cache slots that the cond rows already filled.
+
+        Returns: the logits (U, V) of the uncond rows for the following token.
+        """
+        N = batch.num_requests
+        reqs = torch.tensor(batch.row_requests[N:], dtype=torch.long, device=self.device)
+        offsets = torch.arange(-num_tokens, 0, device=self.device)
+        tokens = batch.output_ids[reqs, batch.output_len - num_tokens:batch.output_len]  # (U, num_tokens)
+        speech_positions = batch.speech_positions[reqs, None] + offsets
+        inputs_embeds = self.speech_emb(tokens) + self.speech_pos_emb.get_fixed_embedding(speech_positions)
+
+        seq_len = batch.seq_len
+        # (the alignment analysis reads the attention of the cond rows' forward)
+        with AttentionSpy.paused(self.tfmr):
+            output = self._get_patched_model()(
+                inputs_embeds=inputs_embeds,
+                past_key_values=cache_row_view(batch.past, slice(N, None)),
+                attention_mask=batch.attention_mask[N:],
+                position_ids=batch.position_ids[N:, None] + offsets,
+                cache_position=torch.arange(seq_len - num_tokens, seq_len, device=self.device),
+                return_dict=True,
+                num_logits_to_keep=1,
+            )
+        return output.logits[:, -1, :]
+
+    def flush_uncond(self, batch: T3DecodeBatch):
+        "Brings the uncond rows of `batch` up to date (see `CFGSchedule.interval`), eg before merging batches."
+        cfg_state = batch.cfg_state
+        if cfg_state is None or cfg_state.uncond_lag == 0:
+            return
+        if batch.num_rows > batch.num_requests:
+            self._advance_uncond(batch, cfg_state.uncond_lag)
+        cfg_state.uncond_lag = 0
+
     @torch.inference_mode()
     def inference(
         self,
@@ -222,150 +605,516 @@ class T3(nn.Module):
         length_penalty=1.0,
         repetition_penalty=1.2,
         cfg_weight=0,
+        prefix_cache: Optional[VoicePrefixCache]=None,
+        voice_id=None,
+        alignment_analysis=False,
+        cfg_schedule: Optional[CFGSchedule]=None,
+        speculative: Optional[SpeculativeConfig]=None,
+        prefill_chunk_size: Optional[int]=None,
+        sync_every: Optional[int]=None,
+        callback: Optional[Callable[[int, int], None]]=None,
+        silence_detector: Optional[SilenceDetector]=None,
     ):
         """
         Args:
-            text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            text_tokens: a 1D (unbatched) or 2D (batched) tensor. With CFG, only the first row is used and the
+                unconditional row is derived from it.
+            prefix_cache / voice_id: reuse the cached conditioning prefix of `voice_id`, see `VoicePrefixCache`.
+            alignment_analysis: stop runaway generations early, see `inference_batch`.
+            cfg_schedule: when to run the CFG uncond row, see `CFGSchedule`.
+            speculative: decode a single request with `inference_speculative` instead.
+            num_return_sequences: sample this many candidates per row in a single batch and keep the best one, see
+                `inference_batch`.
+            prefill_chunk_size: feed the prompt to the backbone in chunks of this many tokens, see `start_prefill`.
+            sync_every / callback: check for EOS on the host only every `sync_every` steps, reporting progress to
+                `callback` instead of tqdm, see `inference_batch`.
+            silence_detector: stop on trailing silence, see `inference_batch`.
+        Returns:
+            (B, num_tokens) speech tokens, rows of different lengths are right-padded with `stop_speech_token`.
         """
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
+        assert initial_speech_tokens is None, "not implemented"
         _ensure_BOT_EOT(text_tokens, self.hp)
         text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
+        if cfg_weight > 0.0:
+            text_tokens = text_tokens[:1]  # the second CFG row is built by `prepare_prompt_embeds`
 
-        # Default initial speech to a single start-of-speech token
-        if initial_speech_tokens is None:
-            initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
+        if speculative is not None:
+            assert text_tokens.size(0) == 1, "speculative decoding handles a single request"
+            assert not alignment_analysis and cfg_schedule is None and prefix_cache is None, "not implemented"
+            assert num_return_sequences == 1, "not implemented"
+            return self.inference_speculative(
+                t3_cond=t3_cond,
+                text_tokens=text_tokens,
+                speculative=speculative,
+                max_new_tokens=max_new_tokens,
+                stop_on_eos=stop_on_eos,
+                temperature=temperature,
+                min_p=min_p,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                cfg_weight=cfg_weight,
+            )[None]
 
-        # Prepare custom input embeds
-        embeds, len_cond = self.prepare_input_embeds(
-            t3_cond=t3_cond,
-            text_tokens=text_tokens,
-            speech_tokens=initial_speech_tokens,
+        predicted = self.inference_batch(
+            t3_conds=[t3_cond] * text_tokens.size(0),
+            text_tokens=list(text_tokens),
+            max_new_tokens=max_new_tokens,
+            stop_on_eos=stop_on_eos,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
             cfg_weight=cfg_weight,
+            prefix_cache=prefix_cache,
+            voice_ids=[voice_id] * text_tokens.size(0),
+            alignment_analysis=alignment_analysis,
+            cfg_schedule=cfg_schedule,
+            num_return_sequences=num_return_sequences,
+            prefill_chunk_size=prefill_chunk_size,
+            sync_every=sync_every,
+            callback=callback,
+            silence_detector=silence_detector,
         )
+        return pad_sequence(predicted, batch_first=True, padding_value=self.hp.stop_speech_token)
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        *,
+        t3_conds: List[T3Cond],
+        text_tokens: List[Tensor],
+        max_new_tokens=None,
+        stop_on_eos=True,
+        temperature=0.8,
+        min_p=0.05,
+        top_p=1.00,
+        repetition_penalty=1.2,
+        cfg_weight=0,
+        cache_implementation="static",
+        prefix_cache: Optional[VoicePrefixCache]=None,
+        voice_ids: Optional[List]=None,
+        alignment_analysis=False,
+        cfg_schedule: Optional[CFGSchedule]=None,
+        num_return_sequences=1,
+        prefill_chunk_size: Optional[int]=None,
+        sync_every: Optional[int]=None,
+        callback: Optional[Callable[[int, int], None]]=None,
+        silence_detector: Optional[SilenceDetector]=None,
+    ) -> List[Tensor]:
+        """
+        Decodes N independent (text, T3Cond) requests as a single batch, so the backbone runs once per step for
+        all of them. Requests are retired from the batch (and the KV cache) as soon as they emit EOS.
 
-        # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
-        # Note the llama-specific logic. Other tfmr types can be added later.
+        Args:
+            t3_conds: one `T3Cond` per request
+            text_tokens: one 1D tensor per request, including start / stop text tokens
+            cache_implementation: "static" pre-allocates the KV cache for `max_new_tokens` and writes it in place,
+                "dynamic" grows it by concatenation on every step.
+            prefix_cache / voice_ids: reuse the cached conditioning prefix of each request's voice (None entries
+                opt out), see `prefill_batch`.
+            alignment_analysis: run an `AlignmentStreamAnalyzer` per request, which forces EOS on long tails /
+                repetitions once the text is covered (and suppresses EOS until then).
+            cfg_schedule: when to run the CFG uncond rows, see `CFGSchedule`.
+            num_return_sequences: best-of-N. After a single prefill, every request is forked into this many
+                candidates that are sampled side by side in the batch, and the best one is returned according to
+                `select_candidate` (alignment coverage with `alignment_analysis`, EOS and length sanity). The scores
+                are kept in `self.candidate_scores`.
+            prefill_chunk_size: feed the prompts to the backbone in chunks of this many tokens, which bounds the
+                prefill activation memory of long texts, see `start_prefill`.
+            sync_every: only check for finished requests every this many steps. In between, EOS bookkeeping stays
+                on the device (rows that finished keep emitting EOS, trimmed afterwards), so the host doesn't wait
+                for every token, at the cost of up to `sync_every - 1` wasted steps per request. Alignment analysis,
+                top-p and CFG convergence checks still sync on every step.
+            callback: called with `(num_steps, num_active_requests)` at every host check instead of the tqdm
+                progress bar, in `sync_every` mode.
+            silence_detector: force EOS on requests that emit a run of silence tokens once their text is covered
+                (per `alignment_analysis`, without it nothing is stopped unless `SilenceDetector.max_run` is set).
+                The silence is left in the returned tokens, use `SilenceDetector.trim` before vocoding.
+        Returns:
+            one 1D tensor of speech tokens per request, including the final EOS token when it was emitted.
+        """
+        assert len(t3_conds) == len(text_tokens)
+        for tt in text_tokens:
+            _ensure_BOT_EOT(torch.atleast_2d(tt), self.hp)
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
+        eos_token = self.hp.stop_speech_token if stop_on_eos else -1
 
         self.compiled = False
+        assert cache_implementation in ("static", "dynamic"), cache_implementation
+        sampling_params = SamplingParams(
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=float(repetition_penalty),
+        )
+        analyzer = None
+        if alignment_analysis:
+            analyzer = BatchAlignmentAnalyzer(self.tfmr, eos_idx=self.hp.stop_speech_token)
+            for req_idx, tt in enumerate(text_tokens):
+                analyzer.add(req_idx, tt.size(-1), num_bos=2 if cfg_weight > 0 else 1)
 
-        # TODO? synchronize the expensive compile function
-        # with self.compile_lock:
-        if not self.compiled:
-            patched_model = T3HuggingfaceBackend(
-                config=self.cfg,
-                llama=self.tfmr,
-                speech_enc=self.speech_emb,
-                speech_head=self.speech_head,
-                alignment_stream_analyzer=None,
+        try:
+            batch, logits = self.prefill_batch(
+                t3_conds=t3_conds,
+                text_tokens=text_tokens,
+                cfg_weights=[float(cfg_weight)] * len(t3_conds),
+                sampling_params=[sampling_params] * len(t3_conds),
+                max_new_tokens=max_new_tokens if cache_implementation == "static" else None,
+                prefix_cache=prefix_cache,
+                voice_ids=voice_ids,
+                cfg_schedule=cfg_schedule,
+                chunk_size=prefill_chunk_size,
             )
-            self.patched_model = patched_model
-            self.compiled = True
+            if analyzer is not None:
+                logits = analyzer.step(batch, logits)
+            if num_return_sequences > 1:
+                # the candidates share the prompt KV computed above
+                batch.repeat_requests(num_return_sequences)
+                logits = logits.repeat_interleave(num_return_sequences, dim=0)
+                if analyzer is not None:
+                    analyzer.repeat_requests(num_return_sequences)
 
-        # # Run normal generate method, which calls our custom extended methods
-        # return self.patched_model.generate(
-        #     inputs=initial_speech_tokens,
-        #     decoder_cond=embeds,
-        #     bos_token_id=self.hp.start_speech_token,
-        #     eos_token_id=(self.hp.stop_speech_token if stop_on_eos else -1),
-        #     pad_token_id=self.hp.stop_speech_token,
-        #     max_new_tokens=max_new_tokens or self.hp.max_speech_tokens,
-        #     num_return_sequences=num_return_sequences,
-        #     temperature=temperature,
-        #     min_p=min_p,
-        #     length_penalty=length_penalty,
-        #     repetition_penalty=repetition_penalty,
-        #     do_sample=do_sample,
-        #     # cache_implementation=None if not self.compiled else "static",
-        # )
-
-        device = embeds.device
-
-        bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
-        bos_embed = self.speech_emb(bos_token)  # shape: (B, 1, embed_dim)
-        bos_embed = bos_embed + self.speech_pos_emb.get_fixed_embedding(0)
-
-        # batch_size=2 for CFG
-        bos_embed = torch.cat([bos_embed, bos_embed])
-
-        # Combine condition and BOS token for the initial input if cfg_weight > 0
-        if cfg_weight > 0:
-            inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
-        else:
-            inputs_embeds = embeds
+            predicted = [None] * batch.num_requests
+            alignments = [None] * batch.num_requests
+            if sync_every is None:
+                steps = tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True)
+            else:
+                steps = range(max_new_tokens)
+                # per request, whether it emitted EOS, and its number of tokens up to and including that EOS
+                done = torch.zeros(batch.num_requests, dtype=torch.bool, device=self.device)
+                num_valid = torch.zeros(batch.num_requests, dtype=torch.long, device=self.device)
+            if silence_detector is not None:
+                is_silence = silence_detector.lookup_table(batch.sampler.vocab_size, device=self.device)
+                silence_runs = torch.zeros(batch.num_requests, dtype=torch.long, device=self.device)
+            for i in steps:
+                next_tokens = batch.sampler(logits)  # shape: (N, 1)
+                last_step = i == max_new_tokens - 1
+                if sync_every is None:
+                    batch.append_tokens(next_tokens)
+                    finished = (next_tokens.view(-1) == eos_token).tolist()
+                    lengths = batch.num_generated
+                else:
+                    next_tokens = next_tokens.masked_fill(done[:, None], self.hp.stop_speech_token)
+                    batch.append_tokens(next_tokens)
+                    num_valid += ~done
+                    done |= next_tokens.view(-1) == eos_token
+                    finished = None
+                    if (i + 1) % sync_every == 0 or last_step:
+                        # the only host sync of the interval
+                        host_state = torch.stack([done.long(), num_valid]).tolist()
+                        finished, lengths = [bool(d) for d in host_state[0]], host_state[1]
+                        if callback is not None:
+                            callback(i + 1, batch.num_requests - sum(finished))
 
-        # Track generated token ids; start with the BOS token.
-        generated_ids = bos_token.clone()
-        predicted = []  # To store the predicted tokens
+                if silence_detector is not None:
+                    silence_runs = torch.where(is_silence[next_tokens.view(-1)], silence_runs + 1, 0)
 
-        # Instantiate the logits processors.
-        min_p_warper = MinPLogitsWarper(min_p=min_p)
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
+                # Retire the requests that emitted EOS, and everything on the last step.
+                if finished is not None and (any(finished) or last_step):
+                    for req_idx, is_finished in enumerate(finished):
+                        if is_finished or last_step:
+                            request_id = batch.request_ids[req_idx]
+                            # drops the EOS tokens emitted after the first one, in `sync_every` mode
+                            predicted[request_id] = batch.get_generated(req_idx)[:lengths[req_idx]]
+                            if analyzer is not None:
+                                alignments[request_id] = analyzer.get(request_id)
+                                analyzer.finish(request_id, lengths[req_idx], max_new_tokens)
+                    keep = [req_idx for req_idx, is_finished in enumerate(finished) if not is_finished]
+                    if last_step or len(keep) == 0:
+                        break
+                    batch.filter(keep)
+                    next_tokens = next_tokens[keep]
+                    if sync_every is not None:
+                        done, num_valid = done[keep], num_valid[keep]
+                    if silence_detector is not None:
+                        silence_runs = silence_runs[keep]
 
-        # ---- Initial Forward Pass (no kv_cache yet) ----
-        output = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=None,
-            use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
-            return_dict=True,
+                logits = self.decode_step(batch, next_tokens)
+                if analyzer is not None:
+                    logits = analyzer.step(batch, logits)
+                if silence_detector is not None:
+                    aligned = [
+                        analyzer is not None and analyzer.get(request_id).complete for request_id in batch.request_ids
+                    ]
+                    aligned = torch.tensor(aligned, dtype=torch.bool, device=self.device)
+                    logits = silence_detector.force_eos(logits, silence_runs, aligned, self.hp.stop_speech_token)
+        finally:
+            if analyzer is not None:
+                analyzer.close()
+
+        if num_return_sequences > 1:
+            k = num_return_sequences
+            winners, self.candidate_scores = [], []
+            for req_idx in range(len(t3_conds)):
+                best, scores = select_candidate(
+                    predicted[req_idx * k:(req_idx + 1) * k],
+                    self.hp.stop_speech_token,
+                    alignments[req_idx * k:(req_idx + 1) * k] if analyzer is not None else None,
+                )
+                logger.info(f"request {req_idx}: picked candidate {best}, scores {[round(s.score, 3) for s in scores]}")
+                winners.append(predicted[req_idx * k + best])
+                self.candidate_scores.append(scores)
+            predicted = winners
+        return predicted
+
+    @torch.inference_mode()
+    def inference_stream(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        chunk_size=25,
+        first_chunk_size=None,
+        max_new_tokens=None,
+        stop_on_eos=True,
+        temperature=0.8,
+        min_p=0.05,
+        top_p=1.00,
+        repetition_penalty=1.2,
+        cfg_weight=0,
+        cache_implementation="static",
+        prefix_cache: Optional[VoicePrefixCache]=None,
+        voice_id=None,
+        alignment_analysis=False,
+        cfg_schedule: Optional[CFGSchedule]=None,
+        prefill_chunk_size: Optional[int]=None,
+    ) -> Iterator[Tensor]:
+        """
+        Generator version of `inference` for a single request: yields 1D chunks of speech tokens as they are
+        sampled, every `chunk_size` tokens (`first_chunk_size` for the first one, to get audio out sooner). The
+        last chunk may be shorter and ends with the EOS token when it was emitted.
+
+        Closing the generator (`.close()`, or breaking out of a for loop) stops decoding and frees the KV cache.
+
+        NOTE: with `alignment_analysis`, the attention spy stays installed on the backbone until the generator is
+        done, so the model shouldn't be shared with other generations in the meantime.
+        """
+        _ensure_BOT_EOT(torch.atleast_2d(text_tokens), self.hp)
+        text_tokens = torch.atleast_2d(text_tokens)[0].to(dtype=torch.long, device=self.device)
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
+        eos_token = self.hp.stop_speech_token if stop_on_eos else -1
+        next_chunk_end = first_chunk_size or chunk_size
+
+        self.compiled = False
+        assert cache_implementation in ("static", "dynamic"), cache_implementation
+        sampling_params = SamplingParams(
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=float(repetition_penalty),
         )
-        # Initialize kv_cache with the full context.
-        past = output.past_key_values
+        analyzer = None
+        if alignment_analysis:
+            analyzer = BatchAlignmentAnalyzer(self.tfmr, eos_idx=self.hp.stop_speech_token)
+            analyzer.add(0, text_tokens.size(-1), num_bos=2 if cfg_weight > 0 else 1)
+
+        emitted = 0
+        try:
+            batch, logits = self.prefill_batch(
+                t3_conds=[t3_cond],
+                text_tokens=[text_tokens],
+                cfg_weights=[float(cfg_weight)],
+                sampling_params=[sampling_params],
+                max_new_tokens=max_new_tokens if cache_implementation == "static" else None,
+                prefix_cache=prefix_cache,
+                voice_ids=[voice_id],
+                cfg_schedule=cfg_schedule,
+                chunk_size=prefill_chunk_size,
+            )
+            for i in range(max_new_tokens):
+                if analyzer is not None:
+                    logits = analyzer.step(batch, logits)
+                next_tokens = batch.sampler(logits)  # shape: (1, 1)
+                batch.append_tokens(next_tokens)
+                finished = int(next_tokens) == eos_token or i == max_new_tokens - 1
+
+                if finished or batch.output_len >= next_chunk_end:
+                    # a single request is never concatenated, so its tokens start at column 0
+                    yield batch.output_ids[0, emitted:batch.output_len].clone()
+                    emitted = batch.output_len
+                    next_chunk_end = emitted + chunk_size
+                if finished:
+                    if analyzer is not None:
+                        analyzer.finish(0, batch.num_generated[0], max_new_tokens)
+                    break
+
+                logits = self.decode_step(batch, next_tokens)
+        finally:
+            # also reached on cancellation: drop the KV cache right away rather than whenever the generator is
+            # garbage collected
+            batch = logits = None
+            if analyzer is not None:
+                analyzer.close()
+
+    def _run_layers(self, hidden_states: Tensor, past, cache_position: Tensor, layers: range):
+        """
+        Runs `hidden_states` (R, S, dim) of unpadded rows through a subset of the backbone layers, writing their keys
+        / values at `cache_position` (S,). Used to split the backbone for self-speculative decoding.
+        """
+        R, S, _ = hidden_states.shape
+        position_ids = cache_position[None].expand(R, -1)
+        position_embeddings = self.tfmr.rotary_emb(hidden_states, position_ids)
+
+        # causal mask over every slot the attention can see after this write
+        kv_len = past.max_cache_len if isinstance(past, T3StaticCache) else int(cache_position[-1]) + 1
+        slots = torch.arange(kv_len, device=self.device)
+        mask = torch.zeros(S, kv_len, dtype=hidden_states.dtype, device=self.device)
+        mask.masked_fill_(slots[None] > cache_position[:, None], torch.finfo(hidden_states.dtype).min)
 
-        # ---- Generation Loop using kv_cache ----
-        for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits = output.logits[:, -1, :]
+        for layer_idx in layers:
+            hidden_states = self.tfmr.layers[layer_idx](
+                hidden_states,
+                attention_mask=mask[None, None],
+                position_ids=position_ids,
+                past_key_value=past,
+                use_cache=True,
+                cache_position=cache_position,
+                position_embeddings=position_embeddings,
+            )[0]
+        return hidden_states
 
-            # CFG
-            if cfg_weight > 0.0:
-                logits_cond = logits[0:1]
-                logits_uncond = logits[1:2]
-                logits = logits_cond + cfg_weight * (logits_cond - logits_uncond)
+    def _speech_logits(self, hidden_states: Tensor, cfg_weight: float):
+        "CFG-combined speech logits (S, V) from the (1 or 2, S, dim) hidden states of the last layer run."
+        logits = self.speech_head(self.tfmr.norm(hidden_states))
+        if logits.size(0) > 1:
+            logits = logits[0] + cfg_weight * (logits[0] - logits[1])
+        else:
+            logits = logits[0]
+        return logits
 
-            logits = logits.squeeze(1)
+    @torch.inference_mode()
+    def inference_speculative(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        speculative: Optional[SpeculativeConfig]=None,
+        max_new_tokens=None,
+        stop_on_eos=True,
+        temperature=0.8,
+        min_p=0.05,
+        top_p=1.00,
+        repetition_penalty=1.2,
+        cfg_weight=0,
+        cache_implementation="static",
+    ) -> Tensor:
+        """
+        Self-speculative decoding of a single request: the first `speculative.draft_layers` layers of the backbone
+        (with the final norm and `speech_head` as an early exit) draft `num_draft_tokens` tokens, then the remaining
+        layers verify them in a single pass, starting from the draft's hidden states. The keys / values the draft
+        computed for its layers are kept, so a round costs about one full-depth pass plus the draft layers for
+        every drafted token.
 
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
+        Drafts are accepted by rejection sampling against the full model's distribution (CFG, temperature,
+        repetition penalty, min-p and top-p included), so the output has the same distribution as `inference`.
+        Acceptance metrics are logged and kept in `self.speculative_stats`.
 
-            # Apply repetition penalty and top‑p filtering.
-            logits = repetition_penalty_processor(generated_ids, logits)
-            logits = min_p_warper(None, logits)
-            logits = top_p_warper(None, logits)
+        Returns: 1D speech tokens, including the final EOS token when it was emitted.
+        """
+        _ensure_BOT_EOT(torch.atleast_2d(text_tokens), self.hp)
+        text_tokens = torch.atleast_2d(text_tokens)[0].to(dtype=torch.long, device=self.device)
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
+        eos_token = self.hp.stop_speech_token if stop_on_eos else -1
+        speculative = speculative or SpeculativeConfig()
+        draft_layers = range(speculative.draft_layers)
+        verify_layers = range(speculative.draft_layers, self.cfg.num_hidden_layers)
+        assert 0 < speculative.draft_layers < self.cfg.num_hidden_layers
+        assert cache_implementation in ("static", "dynamic"), cache_implementation
 
-            # Convert logits to probabilities and sample the next token.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
+        sampler = T3Sampler.create(
+            [SamplingParams(temperature=temperature, min_p=min_p, top_p=top_p,
+                            repetition_penalty=float(repetition_penalty))],
+            start_token=self.hp.start_speech_token,
+            stop_token=self.hp.stop_speech_token,
+            device=self.device,
+        )
+        stats = SpeculativeStats()
 
-            predicted.append(next_token)
-            generated_ids = torch.cat([generated_ids, next_token], dim=1)
+        # prefill
+        embeds = self.prepare_prompt_embeds(t3_cond=t3_cond, text_tokens=text_tokens, cfg=cfg_weight > 0)
+        prompt_len = embeds.size(1)
+        if cache_implementation == "static":
+            # room for the draft tokens that overshoot the budget
+            capacity = prompt_len + max_new_tokens + speculative.num_draft_tokens + 1
+            past = T3StaticCache(self.cfg, embeds.size(0), capacity, device=self.device, dtype=embeds.dtype)
+        else:
+            past = DynamicCache()
+        cache_position = torch.arange(prompt_len, device=self.device)
+        hidden_states = self._run_layers(embeds, past, cache_position, range(self.cfg.num_hidden_layers))
+        next_token = sampler(self._speech_logits(hidden_states[:, -1:], cfg_weight))  # (1, 1)
+        sampler.update(next_token)
+        generated = [next_token.view(1)]
+        num_generated = 1
 
-            # Check for EOS token.
-            if next_token.view(-1) == self.hp.stop_speech_token:
-                break
+        def draft_step(token, offset):
+            "Runs `token` (1, 1) through the draft layers, `offset` tokens after the last verified one."
+            embed = self.speech_emb(token) + self.speech_pos_emb.get_fixed_embedding(num_generated + offset)
+            embed = embed.expand(embeds.size(0), -1, -1)
+            position = torch.tensor([seq_len + offset], device=self.device)
+            return self._run_layers(embed, past, position, draft_layers)
 
-            # Get embedding for the new token.
-            next_token_embed = self.speech_emb(next_token)
-            next_token_embed = next_token_embed + self.speech_pos_emb.get_fixed_embedding(i + 1)
+        last_token = next_token
+        while int(last_token) != eos_token and num_generated < max_new_tokens:
+            seq_len = past.get_seq_length()
+            num_draft = min(speculative.num_draft_tokens, max_new_tokens - num_generated)
+            base_counts = sampler.token_counts.clone()
 
-            #  For CFG
-            if cfg_weight > 0.0:
-                next_token_embed = torch.cat([next_token_embed, next_token_embed])
+            # draft, keeping the draft-layer hidden states of every fed token for the verification
+            draft_tokens, draft_probs, draft_hidden = [], [], [draft_step(last_token, 0)]
+            for i in range(num_draft):
+                probs = sampler.probs(self._speech_logits(draft_hidden[-1], cfg_weight))
+                token = sampler.sample(probs)
+                sampler.update(token)
+                draft_tokens.append(token)
+                draft_probs.append(probs[0] / probs.sum())
+                if int(token) == eos_token:
+                    break  # nothing to verify after an EOS
+                draft_hidden.append(draft_step(token, i + 1))
 
-            # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
-                inputs_embeds=next_token_embed,
-                past_key_values=past,
-                output_attentions=True,
-                output_hidden_states=True,
-                return_dict=True,
-            )
-            # Update the kv_cache.
-            past = output.past_key_values
+            # verify all the fed tokens with the remaining layers in one pass
+            hidden_states = torch.cat(draft_hidden, dim=1)
+            cache_position = torch.arange(seq_len, seq_len + hidden_states.size(1), device=self.device)
+            target_logits = self._speech_logits(self._run_layers(hidden_states, past, cache_position, verify_layers),
+                                                cfg_weight)
+
+            # rejection sampling, replaying the repetition penalty histogram token by token
+            sampler.token_counts = base_counts
+            new_tokens = []
+            num_accepted = 0
+            for i, token in enumerate(draft_tokens):
+                probs = sampler.probs(target_logits[i:i + 1])[0]
+                probs = probs / probs.sum()
+                token_id = int(token)
+                accepted = bool(torch.rand(()) * draft_probs[i][token_id] < probs[token_id])
+                if not accepted:
+                    # resample from the part of the target distribution the draft missed
+                    residual = (probs - draft_probs[i]).clamp(min=0)
+                    token = sampler.sample((residual if residual.sum() > 0 else probs)[None])
+                new_tokens.append(token.view(1))
+                sampler.update(token)
+                if not accepted:
+                    break
+                num_accepted += 1
+            if num_accepted == len(draft_tokens) and int(draft_tokens[-1]) != eos_token:
+                # every draft was accepted: the last verified position gives a bonus token
+                token = sampler(target_logits[-1:])
+                new_tokens.append(token.view(1))
+                sampler.update(token)
+
+            # drop the keys / values of the rejected drafts
+            past.crop(seq_len + num_accepted + 1)
+
+            stats.rounds += 1
+            stats.drafted += len(draft_tokens)
+            stats.accepted += num_accepted
+            new_tokens = new_tokens[:max_new_tokens - num_generated]
+            generated += new_tokens
+            num_generated += len(new_tokens)
+            last_token = new_tokens[-1].view(1, 1)
 
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
-        return predicted_tokens
+        stats.generated = num_generated
+        self.speculative_stats = stats
+        logger.info(f"speculative decoding: {stats}")
+        return torch.cat(generated)
@@ -8,11 +8,14 @@ from huggingface_hub import hf_hub_download
 from safetensors.torch import load_file
 
 from .models.t3 import T3
-from .models.s3tokenizer import S3_SR, drop_invalid_tokens
+from .models.s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, drop_invalid_tokens
 from .models.s3gen import S3GEN_SR, S3Gen
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
+from .models.t3.inference.prefix_cache import VoicePrefixCache
+from .models.t3.inference.silence import SilenceDetector
+from .models.t3.inference.token_budget import TokenBudgetEstimator
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -122,6 +125,11 @@ class ChatterboxTTSNoWatermark:
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        self.prefix_cache = None
+        self.silence_detector = None
+        self.s3gen_prompt_cache = None  # (ref dict, its `PromptCache`), with `enable_s3gen_prompt_cache`
+        self.s3gen_prompt_cache_frames = None
+        self.token_budget = TokenBudgetEstimator.from_tokenizer(tokenizer, max_tokens=t3.hp.max_speech_tokens)
         # NOTE: Watermarker removed for this version
 
     @classmethod
@@ -178,6 +186,41 @@ class ChatterboxTTSNoWatermark:
 
         return cls.from_local(Path(local_path).parent, device)
 
+    def enable_prefix_cache(self, max_bytes=1 << 30):
+        """
+        Caches the T3 KV of each voice's conditioning prefix (up to `max_bytes`, least recently used first out),
+        so `generate(..., voice_id=...)` only prefills the text of repeat voices.
+        """
+        self.prefix_cache = VoicePrefixCache(max_bytes=max_bytes)
+        return self.prefix_cache
+
+    def enable_silence_detection(self, **kwargs):
+        """
+        Calibrates a `SilenceDetector` on the S3 tokenizer (`kwargs` go to `SilenceDetector.calibrate`), so that
+        `generate` trims trailing silence before S3Gen. With `alignment_analysis`, T3 also stops on it.
+        """
+        self.silence_detector = SilenceDetector.calibrate(self.s3gen.tokenizer, **kwargs)
+        return self.silence_detector
+
+    def enable_s3gen_prompt_cache(self, decoder_prompt_frames=None):
+        """
+        Encodes each voice's S3Gen reference prompt once (see `S3Gen.prepare_prompt_cache`), so that S3Gen only
+        encodes the new speech tokens of every request. `decoder_prompt_frames` also caps the prompt frames the
+        CFM decoder gets, eg 200 (4s).
+        """
+        self.s3gen_prompt_cache = (None, None)
+        self.s3gen_prompt_cache_frames = decoder_prompt_frames
+
+    def _s3gen_ref(self):
+        "The S3Gen ref dict of the current voice, or its `PromptCache` when enabled."
+        if self.s3gen_prompt_cache is None:
+            return self.conds.gen
+        ref_dict, prompt_cache = self.s3gen_prompt_cache
+        if ref_dict is not self.conds.gen:
+            prompt_cache = self.s3gen.prepare_prompt_cache(self.conds.gen, self.s3gen_prompt_cache_frames)
+            self.s3gen_prompt_cache = (self.conds.gen, prompt_cache)
+        return prompt_cache
+
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
         ## Load reference wav
         s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
@@ -204,17 +247,8 @@ class ChatterboxTTSNoWatermark:
         ).to(device=self.device)
         self.conds = Conditionals(t3_cond, s3gen_ref_dict)
 
-    def generate(
-        self,
-        text,
-        repetition_penalty=1.2,
-        min_p=0.05,
-        top_p=1.0,
-        audio_prompt_path=None,
-        exaggeration=0.5,
-        cfg_weight=0.5,
-        temperature=0.8,
-    ):
+    def _prepare_inputs(self, text, audio_prompt_path, exaggeration, cfg_weight):
+        "Updates the conditionals if needed, returns the text tokens with start / stop tokens."
         if audio_prompt_path:
             self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
         else:
@@ -240,17 +274,61 @@ class ChatterboxTTSNoWatermark:
         eot = self.t3.hp.stop_text_token
         text_tokens = F.pad(text_tokens, (1, 0), value=sot)
         text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return text_tokens
+
+    def generate(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        voice_id=None,
+        alignment_analysis=False,
+        max_new_tokens=None,
+        cfg_schedule=None,
+        num_return_sequences=1,
+        cfm_solver=None,
+    ):
+        """
+        `voice_id` names the current conditionals for the prefix cache (see `enable_prefix_cache`); it must change
+        whenever the voice does, ie when passing another `audio_prompt_path`.
+
+        `alignment_analysis` watches T3's text-speech alignment to stop long tails / repetitions as soon as the text
+        is covered, instead of decoding until `max_new_tokens`.
+
+        `max_new_tokens` defaults to the `token_budget` estimate for the text.
+
+        `cfg_schedule` (a `CFGSchedule`) saves backbone work by running the CFG uncond row on fewer steps.
+
+        `num_return_sequences` samples that many T3 candidates in one batch and only vocodes the best one (see
+        `T3.inference_batch`), instead of regenerating bad takes one after the other.
+
+        `cfm_solver` (an `ODESolver`) trades S3Gen's default 10-step Euler for fewer estimator calls, eg
+        `FAST_SOLVERS["multistep5"]`.
+        """
+        text_tokens = self._prepare_inputs(text, audio_prompt_path, exaggeration, cfg_weight)
+        max_new_tokens = max_new_tokens or self.token_budget.estimate_tokens(text_tokens)
 
         with torch.inference_mode():
             speech_tokens = self.t3.inference(
                 t3_cond=self.conds.t3,
                 text_tokens=text_tokens,
-                max_new_tokens=1000,  # TODO: use the value in config
+                max_new_tokens=max_new_tokens,
                 temperature=temperature,
                 cfg_weight=cfg_weight,
                 repetition_penalty=repetition_penalty,
                 min_p=min_p,
                 top_p=top_p,
+                prefix_cache=self.prefix_cache if voice_id is not None else None,
+                voice_id=voice_id,
+                alignment_analysis=alignment_analysis,
+                cfg_schedule=cfg_schedule,
+                num_return_sequences=num_return_sequences,
+                silence_detector=self.silence_detector,
             )
             # Extract only the conditional batch.
             speech_tokens = speech_tokens[0]
@@ -259,13 +337,70 @@ class ChatterboxTTSNoWatermark:
             speech_tokens = drop_invalid_tokens(speech_tokens)
 
             speech_tokens = speech_tokens[speech_tokens < 6561]
+            if self.silence_detector is not None:
+                speech_tokens = self.silence_detector.trim(speech_tokens)
 
             speech_tokens = speech_tokens.to(self.device)
 
             wav, _ = self.s3gen.inference(
                 speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
+                ref_dict=self._s3gen_ref(),
+                solver=cfm_solver,
             )
             wav = wav.squeeze(0).detach().cpu().numpy()
             # NOTE: No watermarking applied - return raw audio
         return torch.from_numpy(wav).unsqueeze(0)
+
+    def generate_stream(
+        self,
+        text,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        voice_id=None,
+        alignment_analysis=False,
+        max_new_tokens=None,
+        cfg_schedule=None,
+        chunk_size=25,
+        first_chunk_size=10,
+        cfm_solver=None,
+    ):
+        """
+        Streaming version of `generate`: yields (1, samples) raw audio chunks while T3 is still decoding.
+        Speech tokens are handed to S3Gen every `chunk_size` tokens (`first_chunk_size` for the first chunk, which
+        sets the time to first audio).
+
+        Closing the generator stops T3 decoding and frees its KV cache.
+        """
+        text_tokens = self._prepare_inputs(text, audio_prompt_path, exaggeration, cfg_weight)
+        max_new_tokens = max_new_tokens or self.token_budget.estimate_tokens(text_tokens)
+
+        token_stream = self.t3.inference_stream(
+            t3_cond=self.conds.t3,
+            text_tokens=text_tokens,
+            chunk_size=chunk_size,
+            first_chunk_size=first_chunk_size,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+            prefix_cache=self.prefix_cache if voice_id is not None else None,
+            voice_id=voice_id,
+            alignment_analysis=alignment_analysis,
+            cfg_schedule=cfg_schedule,
+        )
+        # drop EOS / invalid tokens. NOTE: both stages run in inference mode on their own, which must not leak
+        # into the caller between chunks
+        speech_token_chunks = (chunk[chunk < SPEECH_VOCAB_SIZE] for chunk in token_stream)
+        try:
+            for wav in self.s3gen.inference_stream(speech_token_chunks, ref_dict=self._s3gen_ref(), solver=cfm_solver):
+                # NOTE: No watermarking applied - yield raw audio
+                yield wav.detach().cpu()
+        finally:
+            token_stream.close()
@@ -0,0 +1,26 @@
+from transformers import LlamaConfig, LlamaModel
+
+from chatterbox.models.t3.inference.alignment_stream_analyzer import BatchAlignmentAnalyzer
+
+
+def test_repeat_requests_keeps_each_requests_state():
+    config = LlamaConfig(hidden_size=8, intermediate_size=16, num_attention_heads=2, num_hidden_layers=1)
+    analyzer = BatchAlignmentAnalyzer(LlamaModel(config), alignment_layer_idx=0)
+    try:
+        # 2 requests with different texts and progress
+        analyzer.add(0, num_text_tokens=5, num_bos=2)
+        analyzer.add(1, num_text_tokens=9, num_bos=2)
+        analyzer.get(1).curr_frame_pos = 3
+
+        analyzer.repeat_requests(2)
+
+        assert sorted(analyzer.analyzers) == [0, 1, 2, 3]
+        for request_id, (num_text_tokens, frame_pos) in enumerate([(5, 0), (5, 0), (9, 3), (9, 3)]):
+            state = analyzer.get(request_id)
+            assert state.text_tokens_slice == (0, num_text_tokens)
+            assert state.curr_frame_pos == frame_pos
+            assert analyzer.text_offsets[request_id] == (num_text_tokens + 2, 2)
+        # the copies are independent
+        assert analyzer.get(2) is not analyzer.get(3)
+    finally:
+        analyzer.close()
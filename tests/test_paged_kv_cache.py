@@ -0,0 +1,85 @@
+import torch
+from transformers import LlamaConfig
+
+from chatterbox.models.t3.inference.paged_kv_cache import KVBlockPool, PagedKVCache
+from chatterbox.models.t3.inference.prefix_cache import VoicePrefix
+
+
+def _pool(num_blocks=8, block_size=4):
+    config = LlamaConfig(hidden_size=8, num_attention_heads=2, num_key_value_heads=2, num_hidden_layers=1)
+    return KVBlockPool(config, num_blocks, block_size)
+
+
+def _prefix(length, generator):
+    kv = torch.randn(1, 2, length, 4, generator=generator)
+    return VoicePrefix(keys=[kv], values=[-kv])
+
+
+def _append(cache, num_tokens, generator):
+    kv = torch.randn(cache.num_rows, 2, num_tokens, 4, generator=generator)
+    return cache.update(kv, -kv, layer_idx=0)
+
+
+def test_copy_on_write_remaps_earlier_slots():
+    generator = torch.Generator().manual_seed(0)
+    pool = _pool()
+    cache = PagedKVCache(pool, num_rows=1)
+    _append(cache, 3, generator)  # a partly filled tail block
+
+    # fork the row, then write into both copies: row 0 copies the shared tail block, row 1 keeps it
+    cache.select_rows(torch.tensor([0, 0]))
+    keys, values = _append(cache, 1, generator)
+    kept_keys, kept_values = keys[:1].clone(), values[:1].clone()
+    shared_block = cache.block_tables[1][-1]
+    assert cache.block_tables[0][-1] != shared_block
+
+    # retire row 1 and hand its (now free) block to someone else
+    cache.select_rows(torch.tensor([0]))
+    assert pool.refcounts[shared_block] == 0
+    while pool.free_blocks[0] != shared_block:
+        pool.free_blocks.rotate(-1)
+    assert pool.allocate() == shared_block
+    pool.write(0, torch.arange(pool.slots(shared_block).start, pool.slots(shared_block).stop),
+               torch.full((4, 2, 4), 100.0), torch.full((4, 2, 4), 100.0))
+
+    keys, values = pool.gather(0, cache.slot_mapping)
+    assert torch.equal(keys.transpose(1, 2), kept_keys)
+    assert torch.equal(values.transpose(1, 2), kept_values)
+
+
+def test_uncached_prefix_is_freed_with_its_last_row():
+    generator = torch.Generator().manual_seed(0)
+    pool = _pool()
+    num_free = pool.num_free_blocks
+    cache = PagedKVCache(pool, num_rows=2)
+    prefix = _prefix(6, generator)
+    cache.share_prefixes([prefix, prefix], prefix_len=6)  # the cond and uncond rows of one request
+    assert not pool.prefixes
+    assert pool.num_free_blocks == num_free - 2  # written once for both rows
+
+    cache.select_rows(torch.tensor([0]))
+    assert pool.num_free_blocks == num_free - 2
+    cache.release()
+    assert pool.num_free_blocks == num_free
+
+
+def test_cached_prefix_is_reused_and_evictable():
+    generator = torch.Generator().manual_seed(0)
+    pool = _pool()
+    num_free = pool.num_free_blocks
+    prefix = _prefix(6, generator)
+    caches = [PagedKVCache(pool, num_rows=1) for _ in range(2)]
+    for cache in caches:
+        cache.share_prefixes([prefix], prefix_len=6, keys=[("voice", 0.5)])
+    assert list(pool.prefixes) == [("voice", 0.5)]
+    assert caches[0].block_tables == caches[1].block_tables
+    assert pool.num_evictable_blocks == 0
+
+    for cache in caches:
+        cache.release()
+    assert pool.num_free_blocks == num_free - 2
+    assert pool.num_evictable_blocks == 2
+
+    # allocating past the free blocks evicts the unused prefix
+    blocks = [pool.allocate() for _ in range(num_free)]
+    assert not pool.prefixes and len(set(blocks)) == num_free